@@ -0,0 +1,142 @@
+import json
+import os
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import log_archive
+import storage
+
+ANALYTICS_DIRNAME = "analytics"
+CACHE_KEY_FILENAME = "cache_key.json"
+SERIES_FILENAME = "series.npz"
+CHART_FILENAMES = ["attendance_rates.png", "weekly_trend.png", "late_arrivals.png"]
+ANALYTICS_VERSION = 1
+
+# Minutes after the first check-in of the day, for the late arrival histogram
+LATE_BINS = [0, 5, 10, 15, 20, 30, 45, 60, np.inf]
+LATE_LABELS = ["0-5", "5-10", "10-15", "15-20", "20-30", "30-45", "45-60", "60+"]
+
+SECONDS_PER_DAY = 86400
+
+
+# Directory of a course's cached analytics
+def analytics_directory(crn, db_path=storage.DB_PATH):
+    return os.path.join(db_path, crn, ANALYTICS_DIRNAME)
+
+
+# Compute the dashboard series from attendance records:
+# - per-student attendance rate: days with a check-in / class days (days on which anyone checked in)
+# - weekly trend: mean headcount per class day, for each week starting on a Monday
+# - late arrivals: minutes between each student's first check-in of a day and the day's first check-in.
+#   There is no class schedule, so the earliest check-in stands in for the start of class.
+def compute_series(records):
+    present = [(record.timestamp, record.username) for record in records if record.action == 'Present']
+    if not present:
+        return {'names': np.empty(0, dtype=str), 'rates': np.empty(0), 'week_starts': np.empty(0, dtype=str),
+                'weekly_headcount': np.empty(0), 'late_counts': np.zeros(len(LATE_LABELS), dtype=np.int64),
+                'late_minutes_median': np.float64(np.nan)}
+
+    epochs = log_archive.to_epoch([timestamp for timestamp, _ in present])
+    names, codes = np.unique(np.array([username for _, username in present], dtype=str), return_inverse=True)
+    days = epochs // SECONDS_PER_DAY
+
+    # Keep each student's first check-in of each day
+    order = np.lexsort((epochs, days, codes))
+    codes, days, epochs = codes[order], days[order], epochs[order]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (days[1:] != days[:-1])
+    codes, days, epochs = codes[first], days[first], epochs[first]
+
+    class_days, day_index = np.unique(days, return_inverse=True)
+    rates = np.bincount(codes, minlength=len(names)) / len(class_days)
+
+    day_start = np.full(len(class_days), np.iinfo(np.int64).max)
+    np.minimum.at(day_start, day_index, epochs)
+    late_minutes = (epochs - day_start[day_index]) / 60
+    late_counts, _ = np.histogram(late_minutes, bins=LATE_BINS)
+
+    # 1970-01-01 was a Thursday, so shifting by 3 days makes weeks start on Monday
+    headcounts = np.bincount(day_index)
+    weeks, week_index = np.unique((class_days + 3) // 7, return_inverse=True)
+    weekly_headcount = np.bincount(week_index, weights=headcounts) / np.bincount(week_index)
+    week_starts = (weeks * 7 - 3).astype('datetime64[D]').astype(str)
+
+    return {'names': names, 'rates': rates, 'week_starts': week_starts, 'weekly_headcount': weekly_headcount,
+            'late_counts': late_counts, 'late_minutes_median': np.float64(np.median(late_minutes))}
+
+
+# Render the three dashboard charts as PNGs. Uses the Agg canvas directly rather than pyplot, so it is safe
+# to call from a worker thread while Tk owns the main thread.
+def render_charts(series, paths, title):
+    def save(figure, path):
+        FigureCanvasAgg(figure)
+        tmp_path = path + '.tmp'
+        figure.savefig(tmp_path, format='png')
+        os.replace(tmp_path, path)
+
+    figure = Figure(figsize=(5, 3.5), dpi=100, tight_layout=True)
+    axes = figure.add_subplot()
+    axes.hist(series['rates'] * 100, bins=np.arange(0, 110, 10), color="#0066cc")
+    axes.set_title(f"{title}: attendance rates")
+    axes.set_xlabel("Class days attended (%)")
+    axes.set_ylabel("Students")
+    save(figure, paths[0])
+
+    figure = Figure(figsize=(5, 3.5), dpi=100, tight_layout=True)
+    axes = figure.add_subplot()
+    axes.plot(np.array(series['week_starts'], dtype='datetime64[D]'), series['weekly_headcount'],
+              marker='o', color="#009966")
+    axes.set_title("Weekly trend")
+    axes.set_ylabel("Mean headcount per class")
+    figure.autofmt_xdate()
+    save(figure, paths[1])
+
+    figure = Figure(figsize=(5, 3.5), dpi=100, tight_layout=True)
+    axes = figure.add_subplot()
+    axes.bar(LATE_LABELS, series['late_counts'], color="#cc6600")
+    axes.set_title("Arrival after first check-in")
+    axes.set_xlabel("Minutes")
+    axes.set_ylabel("Check-ins")
+    save(figure, paths[2])
+
+
+# One-paragraph summary of the series for the dashboard
+def describe(series):
+    if not len(series['names']):
+        return "No attendance recorded yet."
+    rates = series['rates']
+    return (f"{len(rates)} students, average attendance {100 * rates.mean():.0f}% "
+            f"(median {100 * np.median(rates):.0f}%), {int((rates < 0.9).sum())} below 90%. "
+            f"Median arrival {float(series['late_minutes_median']):.0f} min after the first check-in.")
+
+
+# Return (summary text, chart PNG paths) for a course, recomputing only when its events changed.
+# The series and charts are cached under db/<crn>/analytics/ together with the storage backend's events
+# signature (log size and mtime for the file backend), so re-opening the dashboard just loads the PNGs.
+def get_analytics(crn, db_path=storage.DB_PATH):
+    backend = storage.storage_for(db_path)
+    directory = analytics_directory(crn, db_path)
+    key_path = os.path.join(directory, CACHE_KEY_FILENAME)
+    series_path = os.path.join(directory, SERIES_FILENAME)
+    chart_paths = [os.path.join(directory, filename) for filename in CHART_FILENAMES]
+    key = {'version': ANALYTICS_VERSION, 'signature': backend.events_signature(crn)}
+
+    try:
+        with open(key_path, 'r') as f:
+            cached = json.load(f) == key
+    except (FileNotFoundError, ValueError):
+        cached = False
+    if cached and all(os.path.exists(path) for path in [series_path] + chart_paths):
+        with np.load(series_path, allow_pickle=False) as data:
+            return describe(data), chart_paths
+
+    os.makedirs(directory, exist_ok=True)
+    series = compute_series(backend.iter_events(crn))
+    render_charts(series, chart_paths, f"CRN {crn}")
+    np.savez(series_path + '.tmp.npz', **series)
+    os.replace(series_path + '.tmp.npz', series_path)
+    # Written last, so a crash part way through leaves the cache stale rather than wrong
+    with open(key_path + '.tmp', 'w') as f:
+        json.dump(key, f)
+    os.replace(key_path + '.tmp', key_path)
+    return describe(series), chart_paths
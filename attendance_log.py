@@ -0,0 +1,263 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+DB_PATH = "./db"
+EVENT_LOG_FILENAME = "event_log.txt"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+logger = logging.getLogger(__name__)
+
+# One line of the event log. Both attendance modes write the same four columns; the face recognition
+# mode has no email, so that column is left empty: "2023-10-11 18:37:55, ricky, , Present"
+AttendanceRecord = namedtuple('AttendanceRecord', ['timestamp', 'username', 'email', 'action'])
+
+
+# Path of a course's event log
+def event_log_path(crn, db_path=DB_PATH):
+    return os.path.join(db_path, crn, EVENT_LOG_FILENAME)
+
+
+# Build a record stamped with the current time (or the given datetime)
+def make_record(username, action, email='', when=None):
+    when = when or datetime.now()
+    return AttendanceRecord(when.strftime(TIMESTAMP_FORMAT), username, email or '', action)
+
+
+# Format a record as one event log line
+def format_record(record):
+    return f"{record.timestamp}, {record.username}, {record.email}, {record.action}\n"
+
+
+# Parse one event log line into a record, or None for blank/malformed lines.
+# Accepts the current four-column lines and the older three-column face recognition lines.
+def parse_line(line):
+    parts = line.rstrip('\r\n').split(', ')
+    if len(parts) == 3:
+        timestamp, username, action = parts
+        email = ''
+    elif len(parts) >= 4:
+        timestamp, email, action = parts[0], parts[-2], parts[-1]
+        username = ', '.join(parts[1:-2])
+    else:
+        return None
+    if len(timestamp) != len("YYYY-MM-DD HH:MM:SS"):
+        return None
+    return AttendanceRecord(timestamp, username, email, action)
+
+
+# Hold an exclusive advisory lock on a sidecar .lock file so kiosks on a shared volume never interleave writes
+class FileLock:
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue   # LK_LOCK gives up after ~10 seconds; keep waiting
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+
+
+# Append records to a log file in one locked, fsynced write
+def append_records(path, records):
+    if not records:
+        return
+    data = "".join(format_record(record) for record in records)
+    with FileLock(path):
+        with open(path, 'a') as log_file:
+            log_file.write(data)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+
+# Group-commit writer for one event log.
+# log() only puts the record on a bounded in-memory queue; a background thread collects whatever has queued
+# up for at most flush_interval seconds (or batch_size records) and appends it with a single locked write and
+# fsync. When the queue is full, log() blocks until the writer catches up rather than dropping events.
+# A sink callable taking the batch can replace the file append (e.g. to write to another storage backend).
+# A batch that fails to write is kept and retried with exponential backoff (up to max_retry_delay seconds)
+# until it succeeds; each failure is logged and passed to on_error, called on the writer thread.
+class AttendanceLogWriter:
+    def __init__(self, path, flush_interval=0.5, batch_size=500, max_queue=10000, sink=None, on_error=None,
+                 retry_delay=0.5, max_retry_delay=30):
+        self.path = path
+        self.sink = sink
+        self.on_error = on_error
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None   # error of the batch currently being retried, raised by flush(); None once it is written
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='attendance-log-writer', daemon=True)
+        self._thread.start()
+
+    # Queue one record
+    def log(self, record):
+        if self._closed:
+            raise ValueError("Attendance log writer is closed.")
+        self.queue.put(record)
+
+    # Queue several records
+    def log_many(self, records):
+        for record in records:
+            self.log(record)
+
+    # Block until everything queued so far is on disk. Raises the write error instead of waiting while a batch
+    # is failing; the records stay queued and keep being retried.
+    def flush(self):
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                error = self.error
+                if error is not None:
+                    raise error
+                self.queue.all_tasks_done.wait(0.1)
+
+    # Flush and stop the background thread (raises, leaving the writer open, if the flush fails)
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                return
+
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+
+            self._write_with_retry(batch)
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self.queue.task_done()
+            if stop:
+                return
+
+    # Write a batch, retrying with backoff until it succeeds so a failure never drops records
+    def _write_with_retry(self, batch):
+        delay = self.retry_delay
+        while True:
+            try:
+                self._write(batch)
+                self.error = None
+                return
+            except Exception as e:
+                self.error = e
+                logger.error("Writing %d attendance record(s) to %s failed, retrying in %.1fs: %s",
+                             len(batch), self.path, delay, e)
+                if self.on_error is not None:
+                    try:
+                        self.on_error(e)
+                    except Exception:
+                        logger.exception("Attendance log error callback failed")
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _write(self, batch):
+        if self.sink is not None:
+            self.sink(batch)
+        else:
+            append_records(self.path, batch)
+
+
+# One writer per log file, shared by everything in this process
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+# Return the shared writer for a course's event log. Batches are written through the configured storage
+# backend and the course's presence matrix is then caught up with the log.
+def get_writer(crn, db_path=DB_PATH):
+    # Both build on this module's records
+    import storage
+    import presence_matrix
+    backend = storage.storage_for(db_path)
+
+    def sink(batch):
+        backend.append_events(crn, batch)
+        # The events are stored at this point, so a matrix failure must not make the writer retry the batch;
+        # the matrix catches up from the log the next time it is read
+        try:
+            presence_matrix.get_presence_matrix(crn, db_path)
+        except Exception:
+            logger.exception("Updating the presence matrix of %s failed", crn)
+
+    path = event_log_path(crn, db_path)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = AttendanceLogWriter(path, sink=sink)
+        return writer
+
+
+# Block until every writer has written what is queued so far
+def flush_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+# Flush and close every writer, so nothing queued is lost when the process exits. A writer whose log can't
+# be written is reported rather than stopping the others from closing.
+@atexit.register
+def close_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as e:
+            logger.error("%d attendance record(s) could not be written to %s: %s",
+                         writer.queue.unfinished_tasks, writer.path, e)
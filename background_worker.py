@@ -0,0 +1,75 @@
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import util
+
+logger = logging.getLogger(__name__)
+
+
+# Runs slow jobs (face encoding, matching, disk writes) off the Tk main thread.
+# Jobs execute on a small thread pool; their results are put on a queue that is drained from the
+# Tk event loop with root.after, so callbacks always run on the Tk thread and may touch widgets.
+class BackgroundWorker:
+    def __init__(self, root, max_workers=1, poll_interval=30):
+        self.root = root
+        self.poll_interval = poll_interval   # milliseconds between checks of the result queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='background-worker')
+        self.results = queue.Queue()
+        self.pending = 0
+        self._poll_job = None
+        self._closed = False
+        self._poll()
+
+    # True while at least one submitted job has not reported back yet
+    def busy(self):
+        return self.pending > 0
+
+    # Run fn(*args) in the background; on_done(result) or on_error(exception) is later called on the Tk thread
+    def submit(self, fn, *args, on_done=None, on_error=None):
+        if self._closed:
+            return None
+        self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.results.put((f, on_done, on_error)))
+        return future
+
+    # Deliver finished jobs to their callbacks, then reschedule itself. A callback that raises is logged and
+    # skipped, so the jobs after it are still delivered and polling carries on.
+    def _poll(self):
+        try:
+            while True:
+                try:
+                    future, on_done, on_error = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                self.pending -= 1
+                if future.cancelled():
+                    continue
+                try:
+                    self._deliver(future, on_done, on_error)
+                except Exception:
+                    logger.exception("Background job callback failed")
+        finally:
+            if not self._closed:
+                self._poll_job = self.root.after(self.poll_interval, self._poll)
+
+    def _deliver(self, future, on_done, on_error):
+        error = future.exception()
+        if error is not None:
+            if on_error is not None:
+                on_error(error)
+            else:
+                util.msg_box('Error', f'An error occurred: {error}')
+        elif on_done is not None:
+            on_done(future.result())
+
+    # Stop polling and drop queued jobs; a job already running finishes on its own
+    def shutdown(self):
+        self._closed = True
+        if self._poll_job is not None:
+            try:
+                self.root.after_cancel(self._poll_job)
+            except Exception:
+                pass
+            self._poll_job = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,160 @@
+import argparse
+import csv
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import face_recognition
+import util
+import face_index
+from face_gallery import DEFAULT_TOLERANCE
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+SUMMARY_FILENAME = "enrollment_summary.csv"
+
+
+# List (name, image path) pairs from a directory of photos named after the students, or from a CSV
+# with name,path columns (paths relative to the CSV's folder)
+def read_roster(source):
+    if os.path.isdir(source):
+        return [(os.path.splitext(filename)[0], os.path.join(source, filename))
+                for filename in sorted(os.listdir(source))
+                if filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    roster = []
+    with open(source, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            name, path = row[0].strip(), row[1].strip()
+            if name.lower() == 'name' and path.lower() == 'path':
+                continue  # header row
+            roster.append((name, os.path.join(base_dir, path)))
+    return roster
+
+
+# Decode, detect and encode one roster photo (runs in a worker process).
+# Returns (name, path, status, encoding, detail); status is 'ok', 'unreadable', 'no_face', 'multiple_faces'
+# or 'failed'. Any error is caught here, so one bad photo is reported as a failed row instead of aborting the batch.
+def encode_photo(entry, detection_scale):
+    name, path = entry
+    try:
+        image = face_recognition.load_image_file(path)   # already RGB
+    except Exception as e:
+        return name, path, 'unreadable', None, f"{type(e).__name__}: {e}"
+
+    try:
+        locations = util.detect_faces(image, detection_scale)
+        if len(locations) == 0:
+            return name, path, 'no_face', None, ''
+        if len(locations) > 1:
+            return name, path, 'multiple_faces', None, ''
+        return name, path, 'ok', face_recognition.face_encodings(image, locations)[0], ''
+    except Exception as e:
+        return name, path, 'failed', None, f"{type(e).__name__}: {e}"
+
+
+# Flag encodings that duplicate an existing registration or an earlier photo in the same batch.
+# Returns the detail message for each entry (None when the face is new), computed with two distance matrices.
+def find_duplicates(names, encodings, gallery, tolerance=DEFAULT_TOLERANCE):
+    details = [None] * len(names)
+    if not names:
+        return details
+    encodings = np.asarray(encodings)
+
+    # Against the existing gallery, exactly as util.get_closest_match does for a single registration
+    if len(gallery) > 0:
+        gallery_distances = gallery.distance_matrix(encodings)
+        closest = np.argmin(gallery_distances, axis=1)
+        for i, j in enumerate(closest):
+            if gallery_distances[i, j] < tolerance:
+                details[i] = f"already registered as {gallery.names[j]}"
+
+    # Within the batch: the first photo of a person is kept, later ones are reported
+    squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+    pairwise = squared_norms[:, None] - 2.0 * (encodings @ encodings.T) + squared_norms[None, :]
+    pairwise = np.sqrt(np.maximum(pairwise, 0.0))
+    kept = []
+    for i in range(len(names)):
+        if details[i] is None:
+            earlier = [j for j in kept if pairwise[i, j] < tolerance]
+            if earlier:
+                details[i] = f"same person as {names[earlier[0]]} in this batch"
+            else:
+                kept.append(i)
+    return details
+
+
+# Enroll every photo of a roster into a course's gallery; returns the per-photo results
+def bulk_enroll(crn, source, workers=None, detection_scale=util.DETECTION_SCALE, summary_path=None):
+    roster = read_roster(source)
+    gallery = util.get_face_gallery(crn)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(functools.partial(encode_photo, detection_scale=detection_scale),
+                                    roster, chunksize=4))
+
+    # (name, path, status, detail) for every photo, filled in as the checks run
+    report = []
+    candidates = []
+    seen_names = set()
+    for name, path, status, encoding, detail in results:
+        if status != 'ok':
+            report.append((name, path, status, detail))
+        elif name in gallery or name in seen_names:
+            report.append((name, path, 'duplicate', 'name already registered'))
+        else:
+            seen_names.add(name)
+            candidates.append((name, path, encoding))
+
+    details = find_duplicates([c[0] for c in candidates], [c[2] for c in candidates], gallery)
+    new_names = []
+    new_encodings = []
+    for (name, path, encoding), detail in zip(candidates, details):
+        if detail is not None:
+            report.append((name, path, 'duplicate', detail))
+        else:
+            report.append((name, path, 'enrolled', ''))
+            new_names.append(name)
+            new_encodings.append(encoding)
+
+    # One append for the whole batch
+    gallery.add_many(new_names, new_encodings)
+    face_index.add_many_to_campus_index(crn, new_names, new_encodings, util.DB_PATH)
+
+    if summary_path is None:
+        os.makedirs(os.path.join(util.DB_PATH, crn), exist_ok=True)
+        summary_path = os.path.join(util.DB_PATH, crn, SUMMARY_FILENAME)
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'path', 'status', 'detail'])
+        writer.writerows(report)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll a course roster from a folder (or CSV) of ID photos.")
+    parser.add_argument('crn', help="Course registration number to enroll into")
+    parser.add_argument('source', help="Directory of <name>.jpg photos, or a CSV with name,path columns")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--detection-scale', type=float, default=util.DETECTION_SCALE,
+                        help="Scale of the copy face detection runs on")
+    parser.add_argument('--summary', default=None, help=f"Summary CSV path (default: db/<crn>/{SUMMARY_FILENAME})")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    report = bulk_enroll(args.crn, args.source, args.workers, args.detection_scale, args.summary)
+    elapsed = time.perf_counter() - start
+
+    counts = {}
+    for _, _, status, _ in report:
+        counts[status] = counts.get(status, 0) + 1
+    print(f"Processed {len(report)} photo(s) in {elapsed:.1f}s: "
+          + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    main()
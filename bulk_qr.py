@@ -0,0 +1,116 @@
+import argparse
+import csv
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+import qr_payload
+import storage
+
+# Sheet layout for the printable PDF: codes per row / rows per page, and the label under each code
+SHEET_COLUMNS = 3
+SHEET_ROWS = 4
+LABEL_FONT_SIZE = 9
+
+
+# Read (username, email) pairs from a CSV with username,email columns (a header row is optional)
+def read_students(csv_path):
+    students = []
+    with open(csv_path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip() or not row[1].strip():
+                continue
+            username, email = row[0].strip(), row[1].strip()
+            if username.lower() == 'username' and email.lower() == 'email':
+                continue  # header row
+            students.append((username, email))
+    return students
+
+
+# Lay the codes out on letter pages, SHEET_COLUMNS x SHEET_ROWS per page, with the student's name and email
+def write_pdf_sheet(pdf_path, students, pngs):
+    c = canvas.Canvas(pdf_path, pagesize=letter)
+    width, height = letter
+    margin = 36
+    cell_width = (width - 2 * margin) / SHEET_COLUMNS
+    cell_height = (height - 2 * margin) / SHEET_ROWS
+    code_size = min(cell_width, cell_height) - 3 * LABEL_FONT_SIZE - 8
+    per_page = SHEET_COLUMNS * SHEET_ROWS
+
+    for index, (student, png) in enumerate(zip(students, pngs)):
+        if index and index % per_page == 0:
+            c.showPage()
+        slot = index % per_page
+        column, row = slot % SHEET_COLUMNS, slot // SHEET_COLUMNS
+        x = margin + column * cell_width
+        y = height - margin - (row + 1) * cell_height
+
+        c.drawImage(ImageReader(io.BytesIO(png)), x + (cell_width - code_size) / 2, y + 3 * LABEL_FONT_SIZE,
+                    code_size, code_size)
+        c.setFont("Helvetica", LABEL_FONT_SIZE)
+        c.drawCentredString(x + cell_width / 2, y + 1.8 * LABEL_FONT_SIZE, student['username'])
+        c.drawCentredString(x + cell_width / 2, y + 0.6 * LABEL_FONT_SIZE, student['email'])
+
+    c.save()
+
+
+# Register every new student in the CSV and generate their QR codes.
+# Returns (registered students, skipped emails).
+def bulk_generate(crn, csv_path, workers=None, write_png=True, pdf_path=None):
+    crn_directory_path = os.path.join(storage.DB_PATH, crn)
+    qr_code_directory = os.path.join(crn_directory_path, "qr_codes")
+    os.makedirs(qr_code_directory, exist_ok=True)
+
+    # Already registered: in the roster, or (for codes issued before the roster) a PNG named after the email.
+    # One directory listing replaces an os.path.exists call per student.
+    roster = storage.get_storage().roster(crn)
+    registered = set(roster.by_email)
+    registered.update(filename[:-len('.png')] for filename in os.listdir(qr_code_directory)
+                      if filename.endswith('.png'))
+
+    new_students = []
+    skipped = []
+    for username, email in read_students(csv_path):
+        if email in registered:
+            skipped.append(email)
+        else:
+            registered.add(email)
+            new_students.append((username, email))
+
+    entries = roster.add_many(new_students) if new_students else []
+    payloads = [qr_payload.encode_compact(entry['student_id']) for entry in entries]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pngs = list(executor.map(qr_payload.render_qr_png, payloads, chunksize=16))
+
+    if write_png:
+        for entry, png in zip(entries, pngs):
+            with open(os.path.join(qr_code_directory, f"{entry['email']}.png"), 'wb') as f:
+                f.write(png)
+
+    if pdf_path:
+        write_pdf_sheet(pdf_path, entries, pngs)
+
+    return entries, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Register a course roster for QR check-in and generate its codes.")
+    parser.add_argument('crn', help="Course registration number")
+    parser.add_argument('csv', help="CSV of username,email")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--pdf', default=None, help="Also write a printable multi-page sheet of all new codes")
+    parser.add_argument('--no-png', action='store_true', help="Don't write one PNG per student")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    entries, skipped = bulk_generate(args.crn, args.csv, args.workers, not args.no_png, args.pdf)
+    print(f"Registered {len(entries)} student(s), skipped {len(skipped)} already registered, "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
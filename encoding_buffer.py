@@ -0,0 +1,51 @@
+import numpy as np
+from gallery_store import ENCODING_SIZE
+
+
+# Fixed-size ring of the face encodings from the most recently sampled frames.
+# Each slot holds one frame's encoding, or is marked empty when that frame had no face. A running
+# sum and valid-slot count are updated on every push, so the mean encoding is an O(1) read.
+class EncodingRingBuffer:
+    def __init__(self, capacity, encoding_size=ENCODING_SIZE):
+        self.capacity = capacity
+        self.encodings = np.zeros((capacity, encoding_size), dtype=np.float64)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.total = np.zeros(encoding_size, dtype=np.float64)
+        self.count = 0
+        self.position = 0
+
+    def __len__(self):
+        return self.count
+
+    # Record the encoding of the newest sampled frame (None if it had no face), evicting the oldest slot
+    def push(self, encoding):
+        position = self.position
+        if self.valid[position]:
+            self.total -= self.encodings[position]
+            self.count -= 1
+
+        if encoding is None:
+            self.valid[position] = False
+        else:
+            self.encodings[position] = encoding
+            self.valid[position] = True
+            self.total += self.encodings[position]
+            self.count += 1
+
+        self.position = (position + 1) % self.capacity
+        if self.position == 0:
+            # Re-sum once per lap so floating point error from the add/subtract updates cannot accumulate
+            self.total = self.encodings[self.valid].sum(axis=0)
+
+    # Mean encoding over the slots that contain a face, or None if none do
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    # Forget every buffered encoding
+    def clear(self):
+        self.valid[:] = False
+        self.total[:] = 0.0
+        self.count = 0
+        self.position = 0
@@ -0,0 +1,78 @@
+import argparse
+import csv
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import reports
+import storage
+
+SUMMARY_FILENAME = "export_summary.csv"
+
+
+# Generate one course's reports (runs in a worker process); returns (crn, status, events read, seconds, error)
+def export_course(crn, db_path=storage.DB_PATH, include_events=False):
+    started = time.perf_counter()
+    try:
+        events = reports.generate_course_reports(crn, db_path=db_path)
+        if include_events:
+            events = reports.generate_event_listing(crn, db_path=db_path)
+    except Exception as e:
+        traceback.print_exc()
+        return crn, 'failed', 0, time.perf_counter() - started, f"{type(e).__name__}: {e}"
+    return crn, 'ok', events, time.perf_counter() - started, ''
+
+
+# Export the reports of every course (or the given CRNs) in parallel; returns the per-course results by CRN.
+# Each course writes its own files under db/<crn>/, atomically, so courses never contend and a failed
+# course leaves its previous reports in place.
+def export_all(crns=None, db_path=storage.DB_PATH, workers=None, include_events=False):
+    if not crns:
+        backend = storage.storage_for(db_path)
+        # Only directories with professor details are courses; the file backend's course_exists() is true
+        # for any directory under db/
+        crns = [crn for crn in backend.list_crns() if backend.get_course(crn) is not None]
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_course, crn, db_path, include_events) for crn in crns]
+        for future in as_completed(futures):
+            results.append(future.result())
+    return sorted(results)
+
+
+# Write the per-course results as a CSV
+def write_summary(results, summary_path):
+    tmp_path = summary_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['crn', 'status', 'events_read', 'seconds', 'error'])
+        for crn, status, events, seconds, error in results:
+            writer.writerow([crn, status, events, f"{seconds:.2f}", error])
+    os.replace(tmp_path, summary_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the attendance reports of every course.")
+    parser.add_argument('crns', nargs='*', help="CRNs to export (default: every course)")
+    parser.add_argument('--db', default=storage.DB_PATH, help="Database root directory")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--events', action='store_true', help="Also export the full event listing of each course")
+    parser.add_argument('--summary', default=None, help=f"Summary CSV path (default: db/{SUMMARY_FILENAME})")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    results = export_all(args.crns, args.db, args.workers, args.events)
+    elapsed = time.perf_counter() - started
+
+    for crn, status, events, seconds, error in results:
+        print(f"{crn:>10}  {status:<6} {events:>9} events  {seconds:7.2f}s  {error}")
+    failed = sum(1 for result in results if result[1] != 'ok')
+    print(f"Exported {len(results) - failed} course(s), {failed} failed, in {elapsed:.1f}s")
+
+    write_summary(results, args.summary or os.path.join(args.db, SUMMARY_FILENAME))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
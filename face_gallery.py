@@ -0,0 +1,116 @@
+import threading
+import numpy as np
+from gallery_store import ENCODING_DTYPE, ENCODING_SIZE
+
+# Default distance under which two encodings are considered the same person
+DEFAULT_TOLERANCE = 0.6
+
+
+# In-memory gallery of every registered face encoding for a single CRN.
+# The encodings are held as one (N, 128) matrix loaded from the course's encoding store (memory-mapped
+# from a GalleryStore, or read from SQLite), so a lookup is a single vectorized distance computation.
+# The store must provide load() -> (names, encodings), append_many(names, encodings), signature() and
+# is_stale() (True when the encodings were computed from BGR frames, see gallery_store.COLOR_ORDER).
+class FaceGallery:
+    def __init__(self, store):
+        self.store = store
+        self.names = np.empty(0, dtype=object)
+        self.encodings = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self._squared_norms = np.empty(0, dtype=ENCODING_DTYPE)
+        self._name_set = set()
+        self._signature = None
+        self._lock = threading.Lock()
+
+    # Number of registered faces currently loaded
+    def __len__(self):
+        self.refresh()
+        return len(self.names)
+
+    # Membership test by registered name
+    def __contains__(self, name):
+        self.refresh()
+        return name in self._name_set
+
+    # Load the registered names and encodings from the store
+    def _load(self):
+        names, encodings = self.store.load()
+
+        self.names = np.array(names, dtype=object)
+        self._name_set = set(names)
+        self.encodings = encodings
+        self._squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+
+    # Reload the gallery if the store changed since it was last read
+    def refresh(self):
+        with self._lock:
+            signature = self.store.signature()
+            if signature != self._signature:
+                self._load()
+                # Re-read: migrating legacy pickles on load rewrites the index
+                self._signature = self.store.signature()
+
+    # Force the next lookup to re-read the store
+    def invalidate(self):
+        with self._lock:
+            self._signature = None
+
+    # True when the stored encodings predate RGB conversion and the students should be re-enrolled
+    def is_stale(self):
+        return self.store.is_stale()
+
+    # Register a new face and make it visible to the next lookup
+    def add(self, name, face_encoding):
+        self.add_many([name], [face_encoding])
+
+    # Register several faces with a single append to the store
+    def add_many(self, names, face_encodings):
+        self.store.append_many(names, face_encodings)
+        self.invalidate()
+
+    # Euclidean distance from one encoding to every registered encoding
+    def distances(self, face_encoding):
+        self.refresh()
+        query = np.asarray(face_encoding, dtype=ENCODING_DTYPE)
+        # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, computed for all rows with one matrix-vector product
+        squared = self._squared_norms - 2.0 * (self.encodings @ query) + query @ query
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    # Return (name, distance) of the closest registered face under the tolerance, or (None, None)
+    def closest(self, face_encoding, tolerance=DEFAULT_TOLERANCE):
+        distances = self.distances(face_encoding)
+        if len(distances) == 0:
+            return None, None
+        index = int(np.argmin(distances))
+        if distances[index] < tolerance:
+            return self.names[index], float(distances[index])
+        return None, None
+
+    # Distance matrix between several query encodings (rows) and every registered encoding (columns)
+    def distance_matrix(self, face_encodings):
+        self.refresh()
+        queries = np.asarray(face_encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        squared = query_norms[:, None] - 2.0 * (queries @ self.encodings.T) + self._squared_norms[None, :]
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    # Match N faces against the gallery at once with a one-to-one assignment: every registered student is
+    # given to at most one face, closest pairs first. Returns a (name, distance) or (None, None) per face.
+    def match_many(self, face_encodings, tolerance=DEFAULT_TOLERANCE):
+        matches = [(None, None)] * len(face_encodings)
+        if len(face_encodings) == 0:
+            return matches
+        distances = self.distance_matrix(face_encodings)
+        if distances.shape[1] == 0:
+            return matches
+
+        face_indices, gallery_indices = np.nonzero(distances < tolerance)
+        order = np.argsort(distances[face_indices, gallery_indices], kind='stable')
+        assigned_faces = set()
+        assigned_students = set()
+        for face_index, gallery_index in zip(face_indices[order], gallery_indices[order]):
+            if face_index in assigned_faces or gallery_index in assigned_students:
+                continue
+            assigned_faces.add(face_index)
+            assigned_students.add(gallery_index)
+            matches[face_index] = (self.names[gallery_index], float(distances[face_index, gallery_index]))
+        return matches
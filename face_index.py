@@ -0,0 +1,396 @@
+import argparse
+import os
+import time
+import numpy as np
+from gallery_store import DB_PATH, ENCODING_SIZE, ENCODING_DTYPE
+import attendance_log
+import storage
+
+CAMPUS_INDEX_FILENAME = "campus_index.npz"
+# Dot-prefixed so it stays out of the CRN directories (gallery_store.list_crns skips hidden entries)
+CAMPUS_DELTA_DIRNAME = ".campus_index_delta"
+# Delta files allowed to pile up before they are folded back into the campus index
+MAX_DELTA_FILES = 64
+DEFAULT_TOLERANCE = 0.6
+DEFAULT_N_PROBE = 8
+
+# Rows per block when computing large distance matrices, keeps peak memory bounded
+_BLOCK_ROWS = 4096
+
+
+# Squared Euclidean distances between every row of a and every row of b
+def _squared_distances(a, b, b_squared_norms=None):
+    if b_squared_norms is None:
+        b_squared_norms = np.einsum('ij,ij->i', b, b)
+    a_squared_norms = np.einsum('ij,ij->i', a, a)
+    squared = a_squared_norms[:, None] - 2.0 * (a @ b.T) + b_squared_norms[None, :]
+    return np.maximum(squared, 0.0)
+
+
+# Index of the closest centroid for every row, computed block by block
+def _assign(vectors, centroids):
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _BLOCK_ROWS):
+        block = vectors[start:start + _BLOCK_ROWS]
+        assignment[start:start + len(block)] = np.argmin(_squared_distances(block, centroids, centroid_norms), axis=1)
+    return assignment
+
+
+# Plain k-means with k-means++ seeding, used to train the coarse quantizer
+def kmeans(vectors, n_clusters, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+
+    centroids = np.empty((n_clusters, vectors.shape[1]), dtype=vectors.dtype)
+    centroids[0] = vectors[rng.integers(len(vectors))]
+    closest = _squared_distances(vectors, centroids[:1])[:, 0]
+    for i in range(1, n_clusters):
+        total = closest.sum()
+        if total <= 0:
+            centroids[i] = vectors[rng.integers(len(vectors))]
+        else:
+            centroids[i] = vectors[rng.choice(len(vectors), p=closest / total)]
+        closest = np.minimum(closest, _squared_distances(vectors, centroids[i:i + 1])[:, 0])
+
+    for _ in range(iterations):
+        assignment = _assign(vectors, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assignment, vectors)
+        non_empty = counts > 0
+        centroids[non_empty] = (sums[non_empty] / counts[non_empty, None]).astype(centroids.dtype)
+
+    return centroids
+
+
+# Exact linear scan; the reference every other index is measured against
+class BruteForceIndex:
+    def __init__(self):
+        self.vectors = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self.labels = np.empty(0, dtype=str)
+        self._squared_norms = np.empty(0, dtype=ENCODING_DTYPE)
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Add encodings with their labels
+    def add(self, labels, vectors):
+        vectors = np.asarray(vectors, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        self.vectors = np.vstack([self.vectors, vectors])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=str)])
+        self._squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    # Return the k nearest (label, distance) pairs for one query encoding
+    def search(self, query, k=1):
+        if len(self) == 0:
+            return []
+        query = np.asarray(query, dtype=ENCODING_DTYPE).reshape(1, ENCODING_SIZE)
+        distances = np.sqrt(_squared_distances(query, self.vectors, self._squared_norms)[0])
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(self.labels[i], float(distances[i])) for i in nearest]
+
+
+# Inverted-file index: a k-means coarse quantizer splits the encodings into n_lists cells and a query
+# only scans the n_probe cells whose centroids are closest. Raising n_probe trades latency for recall;
+# n_probe == n_lists is an exact search.
+class IVFIndex:
+    def __init__(self, n_lists, n_probe=DEFAULT_N_PROBE):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.vectors = np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        self.labels = np.empty(0, dtype=str)
+        self.list_ids = np.empty(0, dtype=np.int32)
+        self._members = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Learn the coarse centroids from a sample of the encodings
+    def train(self, vectors, max_training_points=50000, seed=0):
+        vectors = np.asarray(vectors, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        if len(vectors) > max_training_points:
+            sample = np.random.default_rng(seed).choice(len(vectors), max_training_points, replace=False)
+            vectors = vectors[sample]
+        self.centroids = kmeans(vectors, self.n_lists, seed=seed)
+        self.n_lists = len(self.centroids)
+
+    # Add encodings to the cell of their nearest centroid; no retraining needed
+    def add(self, labels, vectors):
+        if self.centroids is None:
+            raise ValueError("IVFIndex must be trained before adding encodings.")
+        vectors = np.asarray(vectors, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        self.vectors = np.vstack([self.vectors, vectors])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=str)])
+        self.list_ids = np.concatenate([self.list_ids, _assign(vectors, self.centroids)])
+        self._members = None
+
+    # Row numbers of every cell, rebuilt lazily after additions
+    def _cell_members(self):
+        if self._members is None:
+            order = np.argsort(self.list_ids, kind='stable')
+            bounds = np.searchsorted(self.list_ids[order], np.arange(self.n_lists + 1))
+            self._members = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+        return self._members
+
+    # Return the k nearest (label, distance) pairs among the n_probe closest cells
+    def search(self, query, k=1, n_probe=None):
+        if len(self) == 0:
+            return []
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        query = np.asarray(query, dtype=ENCODING_DTYPE).reshape(1, ENCODING_SIZE)
+
+        cell_distances = _squared_distances(query, self.centroids)[0]
+        probed = np.argpartition(cell_distances, n_probe - 1)[:n_probe]
+        members = self._cell_members()
+        candidates = np.concatenate([members[cell] for cell in probed])
+        if len(candidates) == 0:
+            return []
+
+        distances = np.sqrt(_squared_distances(query, self.vectors[candidates])[0])
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(self.labels[candidates[i]], float(distances[i])) for i in nearest]
+
+    # Persist the index as a single .npz (no pickled objects), written atomically
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, vectors=self.vectors, labels=self.labels,
+                 list_ids=self.list_ids, n_probe=np.int32(self.n_probe))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(len(data['centroids']), int(data['n_probe']))
+            index.centroids = data['centroids']
+            index.vectors = data['vectors']
+            index.labels = data['labels']
+            index.list_ids = data['list_ids']
+        return index
+
+
+# Labels in the campus index are "<crn>/<name>"
+def make_label(crn, name):
+    return f"{crn}/{name}"
+
+
+# Split a campus index label back into (crn, name)
+def split_label(label):
+    crn, _, name = str(label).partition('/')
+    return crn, name
+
+
+# Path of the persisted campus-wide index
+def campus_index_path(db_path=DB_PATH):
+    return os.path.join(db_path, CAMPUS_INDEX_FILENAME)
+
+
+# Gather every registered encoding under the database root as (labels, vectors)
+def collect_encodings(db_path=DB_PATH):
+    labels = []
+    blocks = []
+    backend = storage.storage_for(db_path)
+    for crn in backend.list_crns():
+        names, encodings = backend.encoding_store(crn).load()
+        labels.extend(make_label(crn, name) for name in names)
+        blocks.append(np.asarray(encodings))
+    vectors = np.vstack(blocks) if blocks else np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+    return labels, vectors
+
+
+# Heuristic cell count: roughly 4 * sqrt(N), never more than N
+def default_n_lists(n_vectors):
+    return max(1, min(n_vectors, int(4 * np.sqrt(max(n_vectors, 1)))))
+
+
+# Directory of the delta files holding registrations added since the campus index was last written
+def campus_delta_directory(db_path=DB_PATH):
+    return os.path.join(db_path, CAMPUS_DELTA_DIRNAME)
+
+
+# Delta files of the campus index, oldest first
+def _list_deltas(db_path=DB_PATH):
+    directory = campus_delta_directory(db_path)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if filename.endswith('.npz') and not filename.endswith('.tmp.npz')]
+
+
+# Changes whenever the campus index is rebuilt or gets new registrations; None if it was never built
+def campus_index_signature(db_path=DB_PATH):
+    try:
+        mtime = os.stat(campus_index_path(db_path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return mtime, tuple(os.path.basename(delta) for delta in _list_deltas(db_path))
+
+
+# The saved index with its pending delta files added. The caller holds the campus index lock.
+def _load_with_deltas(db_path):
+    index = IVFIndex.load(campus_index_path(db_path))
+    for delta in _list_deltas(db_path):
+        with np.load(delta, allow_pickle=False) as data:
+            index.add(data['labels'], data['vectors'])
+    return index
+
+
+# Write an index as the campus index and drop the deltas it now contains. The caller holds the lock.
+def _replace_campus_index(index, db_path):
+    index.save(campus_index_path(db_path))
+    for delta in _list_deltas(db_path):
+        os.remove(delta)
+
+
+# Load the campus index including registrations added since it was written, or None if never built
+def load_campus_index(db_path=DB_PATH):
+    path = campus_index_path(db_path)
+    with attendance_log.FileLock(path):
+        if not os.path.exists(path):
+            return None
+        return _load_with_deltas(db_path)
+
+
+# Train and persist a campus-wide IVF index from all db/*/facial_recognition galleries.
+# The lock is held from collecting the encodings to clearing the deltas, so a registration made meanwhile
+# either is in the collected galleries or lands in a delta written after the rebuild.
+def build_campus_index(db_path=DB_PATH, n_lists=None, n_probe=DEFAULT_N_PROBE):
+    with attendance_log.FileLock(campus_index_path(db_path)):
+        labels, vectors = collect_encodings(db_path)
+        if len(labels) == 0:
+            return None
+        index = IVFIndex(n_lists or default_n_lists(len(labels)), n_probe)
+        index.train(vectors)
+        index.add(labels, vectors)
+        _replace_campus_index(index, db_path)
+    return index
+
+
+# Incrementally add new registrations to the persisted campus index, if one has been built.
+# Each call writes a small delta file instead of rewriting the whole index; once MAX_DELTA_FILES have
+# accumulated they are folded into the index in one rewrite.
+def add_many_to_campus_index(crn, names, encodings, db_path=DB_PATH):
+    path = campus_index_path(db_path)
+    if not names:
+        return
+    with attendance_log.FileLock(path):
+        if not os.path.exists(path):
+            return
+        directory = campus_delta_directory(db_path)
+        os.makedirs(directory, exist_ok=True)
+        # Nanosecond time first so the names sort in the order the deltas were written
+        delta_path = os.path.join(directory, f"{time.time_ns():020d}_{os.getpid()}.npz")
+        np.savez(delta_path[:-len('.npz')] + '.tmp.npz',
+                 labels=np.asarray([make_label(crn, name) for name in names], dtype=str),
+                 vectors=np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE))
+        os.replace(delta_path[:-len('.npz')] + '.tmp.npz', delta_path)
+
+        if len(_list_deltas(db_path)) >= MAX_DELTA_FILES:
+            _replace_campus_index(_load_with_deltas(db_path), db_path)
+
+
+# Incrementally add a single registration to the persisted campus index, if one has been built
+def add_to_campus_index(crn, name, encoding, db_path=DB_PATH):
+    add_many_to_campus_index(crn, [name], [encoding], db_path)
+
+
+# Return (crn, name, distance) of the closest enrolled face across all courses, or None
+def identify(index, encoding, tolerance=DEFAULT_TOLERANCE, n_probe=None):
+    results = index.search(encoding, k=1, n_probe=n_probe)
+    if not results or results[0][1] >= tolerance:
+        return None
+    crn, name = split_label(results[0][0])
+    return crn, name, results[0][1]
+
+
+# Synthetic stand-in for a large enrollment: identities scattered around a handful of
+# demographic clusters, with queries being noisy re-captures of enrolled faces
+def synthetic_encodings(n_vectors, n_queries, seed=0):
+    rng = np.random.default_rng(seed)
+    cluster_centers = rng.normal(0.0, 0.15, size=(64, ENCODING_SIZE))
+    identities = cluster_centers[rng.integers(len(cluster_centers), size=n_vectors)]
+    identities += rng.normal(0.0, 0.05, size=identities.shape)
+    picked = rng.integers(n_vectors, size=n_queries)
+    queries = identities[picked] + rng.normal(0.0, 0.015, size=(n_queries, ENCODING_SIZE))
+    labels = [f"synthetic/{i}" for i in range(n_vectors)]
+    return labels, identities.astype(ENCODING_DTYPE), queries.astype(ENCODING_DTYPE)
+
+
+# Mean per-query latency (ms) and the top-1 labels returned
+def _time_queries(search, queries):
+    found = []
+    start = time.perf_counter()
+    for query in queries:
+        results = search(query)
+        found.append(results[0][0] if results else None)
+    elapsed = time.perf_counter() - start
+    return 1000.0 * elapsed / len(queries), found
+
+
+# Print recall@1 and latency of the IVF index for a sweep of n_probe values against brute force
+def recall_latency_report(labels, vectors, queries, n_lists=None, probes=(1, 2, 4, 8, 16, 32, 64)):
+    brute = BruteForceIndex()
+    brute.add(labels, vectors)
+    brute_ms, truth = _time_queries(lambda q: brute.search(q), queries)
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists or default_n_lists(len(labels)))
+    index.train(vectors)
+    index.add(labels, vectors)
+    build_seconds = time.perf_counter() - start
+
+    print(f"{len(labels)} encodings, {len(queries)} queries, {index.n_lists} lists (built in {build_seconds:.1f}s)")
+    print(f"{'n_probe':>8} {'recall@1':>9} {'ms/query':>9} {'speedup':>8}")
+    print(f"{'brute':>8} {1.0:>9.3f} {brute_ms:>9.3f} {1.0:>7.1f}x")
+    for n_probe in probes:
+        if n_probe > index.n_lists:
+            break
+        ivf_ms, found = _time_queries(lambda q: index.search(q, n_probe=n_probe), queries)
+        recall = np.mean([a == b for a, b in zip(found, truth)])
+        print(f"{n_probe:>8} {recall:>9.3f} {ivf_ms:>9.3f} {brute_ms / ivf_ms:>7.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Campus-wide approximate face index.")
+    parser.add_argument('--db', default=DB_PATH, help="Database root directory")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Train and save the index from every course gallery")
+    build_parser.add_argument('--lists', type=int, default=None, help="Number of k-means cells (default ~4*sqrt(N))")
+    build_parser.add_argument('--probe', type=int, default=DEFAULT_N_PROBE, help="Default cells scanned per query")
+
+    report_parser = subparsers.add_parser('report', help="Recall-vs-latency sweep against brute force")
+    report_parser.add_argument('--synthetic', type=int, default=0,
+                               help="Benchmark on N synthetic encodings instead of the database")
+    report_parser.add_argument('--queries', type=int, default=500, help="Number of queries to time")
+    report_parser.add_argument('--lists', type=int, default=None, help="Number of k-means cells")
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        index = build_campus_index(args.db, args.lists, args.probe)
+        if index is None:
+            print("No registered encodings found.")
+        else:
+            print(f"Indexed {len(index)} encodings in {index.n_lists} lists -> {campus_index_path(args.db)}")
+        return
+
+    if args.synthetic:
+        labels, vectors, queries = synthetic_encodings(args.synthetic, args.queries)
+    else:
+        labels, vectors = collect_encodings(args.db)
+        if len(labels) == 0:
+            print("No registered encodings found.")
+            return
+        rng = np.random.default_rng(0)
+        picked = rng.integers(len(vectors), size=args.queries)
+        queries = vectors[picked] + rng.normal(0.0, 0.015, size=(args.queries, ENCODING_SIZE)).astype(ENCODING_DTYPE)
+    recall_latency_report(labels, vectors, queries, args.lists)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import itertools
+import cv2
+import numpy as np
+from face_gallery import DEFAULT_TOLERANCE
+
+
+# Intersection-over-union of two (top, right, bottom, left) boxes
+def box_iou(a, b):
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    if bottom <= top or right <= left:
+        return 0.0
+    intersection = (bottom - top) * (right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+
+# Area of a (top, right, bottom, left) box
+def box_area(box):
+    return max(0, box[2] - box[0]) * max(0, box[1] - box[3])
+
+
+# Create an OpenCV KCF tracker if this OpenCV build has one (it moved to cv2.legacy in 4.5+), else None
+def create_visual_tracker():
+    for factory in (getattr(cv2, 'TrackerKCF_create', None),
+                    getattr(getattr(cv2, 'legacy', None), 'TrackerKCF_create', None)):
+        if factory is not None:
+            return factory()
+    return None
+
+
+# One face followed across frames, with the identity it was matched to. The identity is cached while the
+# face keeps matching the encoding it was identified from (see FaceTracker.observe).
+class Track:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.identity = None    # registered name once matched
+        self.distance = None
+        self.encoding = None    # latest encoding of the face
+        self.identity_encoding = None   # encoding the identity was matched from
+        self.misses = 0         # consecutive detection passes without a matching box
+        self.visual_tracker = None
+
+
+# Carries face boxes from frame to frame so detection and identification don't have to run on every frame.
+# Full detection runs every detect_every frames, or sooner as soon as a visual tracker loses its face;
+# detections are associated to existing tracks by IoU, so a face that stays in view keeps its track and
+# its cached identity. Between detections each track is advanced with an OpenCV KCF tracker when the
+# installed OpenCV provides one, otherwise the last detected box is kept. Because a different person can
+# step into a track (same spot, or a visual tracker that drifted onto the background), every fresh encoding
+# is checked against the one the identity came from, and the identity is dropped once they no longer match.
+class FaceTracker:
+    def __init__(self, detect_every=5, iou_threshold=0.3, max_misses=2, tracking_scale=0.5,
+                 identity_tolerance=DEFAULT_TOLERANCE):
+        self.detect_every = detect_every
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.identity_tolerance = identity_tolerance
+        self.tracking_scale = tracking_scale   # visual trackers run on a frame downscaled by this factor
+        self.tracks = []
+        self.frames_since_detection = 0
+        self.lost = False
+        self._ids = itertools.count(1)
+
+    # True when the next frame should get a full detection pass
+    def needs_detection(self):
+        return not self.tracks or self.lost or self.frames_since_detection >= self.detect_every
+
+    # Associate freshly detected boxes with the current tracks; returns the tracks created by this update
+    def update(self, boxes, frame=None):
+        pairs = []
+        for track_index, track in enumerate(self.tracks):
+            for box_index, box in enumerate(boxes):
+                iou = box_iou(track.box, box)
+                if iou >= self.iou_threshold:
+                    pairs.append((iou, track_index, box_index))
+        pairs.sort(reverse=True)
+
+        matched_tracks = set()
+        matched_boxes = set()
+        for _, track_index, box_index in pairs:
+            if track_index in matched_tracks or box_index in matched_boxes:
+                continue
+            matched_tracks.add(track_index)
+            matched_boxes.add(box_index)
+            track = self.tracks[track_index]
+            track.box = boxes[box_index]
+            track.misses = 0
+
+        survivors = []
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            survivors.append(track)
+
+        new_tracks = [Track(next(self._ids), box) for box_index, box in enumerate(boxes)
+                      if box_index not in matched_boxes]
+        self.tracks = survivors + new_tracks
+
+        if frame is not None:
+            small = self._tracking_frame(frame)
+            for track in self.tracks:
+                self._start_visual_tracker(track, small)
+
+        self.frames_since_detection = 0
+        self.lost = False
+        return new_tracks
+
+    # Move every track along on a frame without running detection
+    def advance(self, frame):
+        self.frames_since_detection += 1
+        small = self._tracking_frame(frame)
+        for track in self.tracks:
+            if track.visual_tracker is None:
+                continue
+            ok, (x, y, w, h) = track.visual_tracker.update(small)
+            if not ok:
+                track.visual_tracker = None
+                self.lost = True
+                continue
+            s = self.tracking_scale
+            track.box = (int(y / s), int((x + w) / s), int((y + h) / s), int(x / s))
+
+    # The largest tracked face, which is the person standing at the kiosk
+    def primary_track(self):
+        if not self.tracks:
+            return None
+        return max(self.tracks, key=lambda track: box_area(track.box))
+
+    # Record a fresh encoding of a track's face, dropping its identity if the face no longer matches it.
+    # Returns True when the track needs (re-)identifying.
+    def observe(self, track, encoding):
+        track.encoding = encoding
+        if track.identity_encoding is not None:
+            distance = float(np.linalg.norm(np.asarray(encoding) - track.identity_encoding))
+            if distance >= self.identity_tolerance:
+                track.identity = track.distance = track.identity_encoding = None
+        return track.identity is None
+
+    # Cache the identity a track's latest encoding was matched to (name None when nobody matched)
+    def identify(self, track, name, distance):
+        track.identity, track.distance = name, distance
+        track.identity_encoding = np.asarray(track.encoding) if name is not None else None
+
+    # Drop every track, e.g. after the person at the kiosk has been handled
+    def clear(self):
+        self.tracks = []
+        self.frames_since_detection = 0
+        self.lost = False
+
+    def _tracking_frame(self, frame):
+        if self.tracking_scale >= 1.0:
+            return frame
+        return cv2.resize(frame, (0, 0), fx=self.tracking_scale, fy=self.tracking_scale, interpolation=cv2.INTER_AREA)
+
+    def _start_visual_tracker(self, track, small_frame):
+        track.visual_tracker = create_visual_tracker()
+        if track.visual_tracker is None:
+            return
+        top, right, bottom, left = track.box
+        s = self.tracking_scale
+        track.visual_tracker.init(small_frame, (int(left * s), int(top * s), int((right - left) * s), int((bottom - top) * s)))
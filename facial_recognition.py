@@ -3,9 +3,12 @@ import cv2
 from PIL import Image, ImageTk
 import face_recognition
 import util
+from background_worker import BackgroundWorker
+from encoding_buffer import EncodingRingBuffer
+from face_tracker import FaceTracker
+import attendance_log
+import recognition_client
 from datetime import datetime
-import numpy as np
-import pickle
 import os
 
 
@@ -28,22 +31,62 @@ class FaceRecognitionApp:
         self.root.protocol("WM_DELETE_WINDOW", self.destroy)
 
         # Initialization of required variables
-        self.frame_buffer = []
-        self.buffer_size = 10   # the number of frames to keep in the buffer for averaging
+        self.buffer_size = 10   # the number of sampled frames whose encodings are averaged
+        self.encoding_buffer = EncodingRingBuffer(self.buffer_size)
+        self.encoding_in_flight = False   # a sampled frame is currently being encoded
+        self.action_pending = False   # a login/logout/registration job is running
 
         self.frame_skip = 2  # process one frame for every 2 captured
+        self.detection_scale = util.DETECTION_SCALE  # detect faces on a downscaled copy of each frame
         self.frame_count = 0
 
+        # Faces are tracked between sampled frames: detection runs every detect_every sampled frames
+        # (or when a track is lost) and each track is identified once, then re-checked against every fresh
+        # encoding. Only the worker touches the tracker; the Tk thread bumps track_generation to have the
+        # worker clear it before the next frame, and ignores results from an older generation.
+        self.tracker = FaceTracker(detect_every=5)
+        self.track_generation = 0
+        self.tracker_generation = 0   # generation the tracker was last cleared for (worker side)
+        self.primary_track_id = None  # track whose encodings the rolling buffer holds
+        self.tracked_faces = []   # (box, name) of the tracked faces, as last reported by the worker
+        self.hands_free = False   # log attendance automatically as soon as a tracked face is identified
+        self.checked_in = set()   # names logged by hands-free or classroom mode in this session
+
+        # Classroom mode checks in every face in a wide-angle frame at once. Faces are small in those
+        # frames, so detection runs at full resolution by default.
+        self.classroom_mode = False
+        self.classroom_detection_scale = 1.0
+
         # state variables for face recognition
         self.face_detected = False
         self.face_recognized = False
         self.attendance_marked = False
 
+        # Attendance events go through the shared group-commit log writer
+        self.event_log = attendance_log.get_writer(crn)
+
+        # Encoding and matching run on a background worker so the preview keeps rendering
+        self.worker = BackgroundWorker(self.root)
+
+        # With ATTENDANCE_SERVICE_URL set, matching and logging go to the shared recognition service, whose
+        # galleries stay warm across kiosks; otherwise this process does them itself. Both offer the same calls.
+        self.service = recognition_client.get_client()
+        self.recognizer = self.service or util
+
         # Initialize GUI elements
         # Initialize your buttons, labels, etc. here
         self.initialize_ui()
         self.start_webcam()
 
+        # Ask whoever does the matching whether the faces need re-enrolling, so a kiosk using the service
+        # doesn't open the course's gallery itself
+        self.worker.submit(self.recognizer.is_gallery_stale, crn, on_done=self.on_gallery_checked)
+
+    def on_gallery_checked(self, stale):
+        if stale:
+            util.msg_box('Warning', "This course's faces were registered by an older version and may not be "
+                                    "recognized reliably. Please re-enroll the students.")
+
 
     # Setup the UI components like buttons, labels, etc.
     def initialize_ui(self):
@@ -53,47 +96,165 @@ class FaceRecognitionApp:
         self.webcam_label.config(width=640, height=400)
         self.webcam_label.pack(pady=10)
 
+        self.status_label = util.get_text_label(self.root, "", font_size=16)
+        self.status_label.pack()
+
         self.login_button = util.get_button(self.root, 'Login', 'green', self.login)
         self.login_button.pack(pady=10)
 
         self.register_button = util.get_button(self.root, 'Register', 'gray', self.register)
         self.register_button.pack(pady=10)
 
+        self.hands_free_button = util.get_button(self.root, 'Hands-free: Off', 'blue', self.toggle_hands_free)
+        self.hands_free_button.pack(pady=10)
+
+        self.classroom_button = util.get_button(self.root, 'Classroom Mode: Off', 'purple', self.toggle_classroom_mode)
+        self.classroom_button.pack(pady=10)
+
         self.exit_button = util.get_button(self.root, 'Exit', 'red', self.destroy)
         self.exit_button.pack(pady=10)
 
 
-    # Reset the state for the next recognition attempt
+    # Reset the state for the next recognition attempt. The tracks are dropped too, so whoever steps up next
+    # starts a new track instead of inheriting the identity of the person just handled.
     def reset_for_next_recognition(self):
-        self.frame_buffer = []
+        self.encoding_buffer.clear()
+        self.track_generation += 1
+        self.tracked_faces = []
+        self.primary_track_id = None
         self.face_detected = False
         self.face_recognized = False
         self.attendance_marked = False
 
-    # Add the new frame to the buffer and remove the oldest frame if the buffer is full
+    # Send a sampled frame to the background worker for tracking and identification.
+    # Frames arriving while the previous one is still being processed are skipped rather than queued.
     def update_buffer(self, new_frame):
-        if len(self.frame_buffer) >= self.buffer_size:
-            self.frame_buffer.pop(0)
-        self.frame_buffer.append(new_frame)
-
-    # Calculate the average face encoding over the buffered frames
-    def get_average_face_encoding(self):
-        if len(self.frame_buffer) == 0:
-            return None
-
-        average_encoding = None
-        for frame in self.frame_buffer:
-            face_encodings = face_recognition.face_encodings(frame)
-            if len(face_encodings) > 0:
-                if average_encoding is None:
-                    average_encoding = face_encodings[0]
-                else:
-                    average_encoding = np.add(average_encoding, face_encodings[0])
-
-        if average_encoding is not None:
-            average_encoding = np.divide(average_encoding, len(self.frame_buffer))
-
-        return average_encoding
+        if self.encoding_in_flight:
+            return
+        self.encoding_in_flight = True
+        if self.classroom_mode:
+            self.worker.submit(self.recognizer.recognize_all, new_frame, self.crn, self.classroom_detection_scale,
+                               on_done=self.on_classroom_frame_processed, on_error=self.on_frame_processing_error)
+            return
+        self.worker.submit(self.process_frame, new_frame, self.track_generation,
+                           on_done=self.on_frame_processed, on_error=self.on_frame_processing_error)
+
+    # Track faces in a sampled frame and identify any face not seen before (runs on the background worker).
+    # Detection only runs every few frames, but the largest face is encoded on every sampled frame (at its
+    # tracked box) so the rolling buffer gets one encoding per frame.
+    # Returns the track generation, the id of the largest face's track and its encoding (None if no face)
+    # and the tracked faces.
+    def process_frame(self, frame, generation):
+        tracker = self.tracker
+        if generation != self.tracker_generation:
+            tracker.clear()
+            self.tracker_generation = generation
+
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if tracker.needs_detection():
+            tracker.update(util.detect_faces(rgb_frame, self.detection_scale), frame)
+            # Every track: new ones get identified, identified ones are checked to still be that person
+            to_encode = list(tracker.tracks)
+        else:
+            tracker.advance(frame)
+            primary = tracker.primary_track()
+            to_encode = [primary] if primary is not None else []
+
+        if to_encode:
+            encodings = face_recognition.face_encodings(rgb_frame, [track.box for track in to_encode])
+            for track, encoding in zip(to_encode, encodings):
+                if tracker.observe(track, encoding):
+                    tracker.identify(track, *self.recognizer.closest(encoding, self.crn))
+
+        primary = tracker.primary_track()
+        if primary is None:
+            return generation, None, None, self.describe_tracks()
+        return generation, primary.id, primary.encoding, self.describe_tracks()
+
+    # Snapshot of the tracked faces as (box, name) pairs, largest first, safe to hand to the Tk thread
+    def describe_tracks(self):
+        primary = self.tracker.primary_track()
+        tracks = sorted(self.tracker.tracks, key=lambda track: track is not primary)
+        return [(track.box, track.identity) for track in tracks]
+
+    # Handle a processed frame: feed the rolling buffer and, in hands-free mode, log newly identified faces.
+    # The buffer only ever averages one person: it is cleared whenever the largest face is a different track.
+    def on_frame_processed(self, result):
+        self.encoding_in_flight = False
+        generation, primary_track_id, encoding, tracked_faces = result
+        if generation != self.track_generation:
+            return   # tracked before the last reset; the next frame starts over
+        if primary_track_id is not None and primary_track_id != self.primary_track_id:
+            self.encoding_buffer.clear()
+            self.primary_track_id = primary_track_id
+        self.encoding_buffer.push(encoding)
+        self.tracked_faces = tracked_faces
+
+        if self.hands_free:
+            for _, name in tracked_faces:
+                if name is not None and name not in self.checked_in:
+                    self.checked_in.add(name)
+                    self.log_event(name, 'Present')
+                    self.status_label.config(text=f"Welcome, {name}. Attendance marked.")
+                    self.reset_for_next_recognition()
+                    break
+
+    # A frame that failed to process counts as a frame without a face
+    def on_frame_processing_error(self, error):
+        self.encoding_in_flight = False
+        self.encoding_buffer.push(None)
+
+    # Log every student recognized in a classroom frame who has not been checked in yet, in one write
+    def on_classroom_frame_processed(self, names):
+        self.encoding_in_flight = False
+        if not self.classroom_mode:
+            return
+        new_names = [name for name in names if name not in self.checked_in]
+        if new_names:
+            self.checked_in.update(new_names)
+            self.log_events(new_names, 'Present')
+        self.status_label.config(text=f"Classroom mode: {len(self.checked_in)} student(s) checked in")
+
+    # Switch classroom (multi-face) check-in on or off
+    def toggle_classroom_mode(self):
+        self.classroom_mode = not self.classroom_mode
+        self.classroom_button.config(text=f"Classroom Mode: {'On' if self.classroom_mode else 'Off'}")
+        self.tracked_faces = []
+        if self.classroom_mode:
+            self.status_label.config(text=f"Classroom mode: {len(self.checked_in)} student(s) checked in")
+        else:
+            self.status_label.config(text="")
+
+    # Switch automatic, no-button attendance on or off
+    def toggle_hands_free(self):
+        self.hands_free = not self.hands_free
+        self.hands_free_button.config(text=f"Hands-free: {'On' if self.hands_free else 'Off'}")
+
+    # Draw the tracked face boxes and names onto a preview image of the given size
+    def draw_tracked_faces(self, img_rgb, frame_shape):
+        scale_y = img_rgb.shape[0] / frame_shape[0]
+        scale_x = img_rgb.shape[1] / frame_shape[1]
+        for (top, right, bottom, left), name in self.tracked_faces:
+            color = (0, 255, 0) if name else (255, 165, 0)
+            top_left = (int(left * scale_x), int(top * scale_y))
+            cv2.rectangle(img_rgb, top_left, (int(right * scale_x), int(bottom * scale_y)), color, 2)
+            if name:
+                cv2.putText(img_rgb, name, (top_left[0], max(0, top_left[1] - 8)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+    # Show a status message and disable the action buttons while a background job is running
+    def set_busy(self, message):
+        self.action_pending = True
+        self.status_label.config(text=message)
+        self.login_button.config(state=tk.DISABLED)
+        self.register_button.config(state=tk.DISABLED)
+
+    # Clear the status message and re-enable the action buttons
+    def set_idle(self):
+        self.action_pending = False
+        self.status_label.config(text="")
+        self.login_button.config(state=tk.NORMAL)
+        self.register_button.config(state=tk.NORMAL)
 
     # Initialize and start the webcam capture
     def start_webcam(self):
@@ -118,9 +279,10 @@ class FaceRecognitionApp:
 
         if self.frame_count % self.frame_skip == 0:
             self.most_recent_capture = frame
-            self.update_buffer(self.most_recent_capture)
+            self.update_buffer(frame)
             img_rgb = cv2.cvtColor(self.most_recent_capture, cv2.COLOR_BGR2RGB)
             img_rgb = cv2.resize(img_rgb, (640, 480))
+            self.draw_tracked_faces(img_rgb, frame.shape)
 
             self.most_recent_capture_pil = Image.fromarray(img_rgb)
             imgtk = ImageTk.PhotoImage(image=self.most_recent_capture_pil)
@@ -137,18 +299,31 @@ class FaceRecognitionApp:
         self.cap.release()
 
 
-    # Attempt to recognize and login a user using the current frame
+    # Attempt to recognize and login a user from the mean of the buffered encodings
     def login(self):
         if self.cap is None or not self.cap.isOpened():
             util.msg_box('Error', 'Webcam not available.')
             return
+        if self.action_pending:
+            return
 
-        average_encoding = self.get_average_face_encoding()
-        if average_encoding is not None:
-            name = util.recognize_from_encoding(average_encoding, self.crn)
-        else:
-            name = 'no_persons_found'  # Fallback if average encoding couldn't be calculated
+        # The face at the kiosk was already identified by the tracker, no need to match again
+        if self.tracked_faces and self.tracked_faces[0][1] is not None:
+            self.on_login_result(self.tracked_faces[0][1])
+            return
+
+        average_encoding = self.encoding_buffer.mean()
+        if average_encoding is None:
+            self.on_login_result('no_persons_found')  # No face in any of the recent frames
+            return
 
+        self.set_busy("Recognizing\u2026")
+        self.worker.submit(self.recognizer.recognize_from_encoding, average_encoding, self.crn,
+                           on_done=self.on_login_result, on_error=self.on_worker_error)
+
+    # Handle the result of a login recognition job
+    def on_login_result(self, name):
+        self.set_idle()
         if name in ['unknown_person', 'no_persons_found']:
             util.msg_box('Oops...', 'Unknown user. Please register new user or try again.')
         else:
@@ -161,28 +336,46 @@ class FaceRecognitionApp:
         if self.cap is None or not self.cap.isOpened():
             util.msg_box('Error', 'Webcam not available.')
             return
+        if self.action_pending:
+            return
 
-        # Your logout logic here
-        name = util.recognize(self.most_recent_capture)
+        self.set_busy("Recognizing\u2026")
+        self.worker.submit(self.recognizer.recognize, self.most_recent_capture, self.crn, self.detection_scale,
+                           on_done=self.on_logout_result, on_error=self.on_worker_error)
 
+    # Handle the result of a logout recognition job
+    def on_logout_result(self, name):
+        self.set_idle()
         if name in ['unknown_person', 'no_persons_found']:
             util.msg_box('ops...', 'Unknown user. Please register new user or try again.')
         else:
             self.root.after(250, self.root.quit)  # Close the Tkinter window after 3000 milliseconds
-
-        if name not in ['unknown_person', 'no_persons_found']:
             self.log_event(name, 'exited app')
             self.reset_for_next_recognition()
 
+    # Report a failed background job and restore the UI
+    def on_worker_error(self, error):
+        self.set_idle()
+        util.msg_box('Error', f'An error occurred: {error}')
+
 
     # Log an event (e.g., login, logout) for a specific user
     def log_event(self, username, action):
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_message = f"{current_time}, {username}, {action}\n"
+        self.log_events([username], action)
+
+    # Log the same event for several users; the shared writer appends them in one batched write
+    def log_events(self, usernames, action):
+        now = datetime.now()
+        records = [attendance_log.make_record(username, action, when=now) for username in usernames]
+        if self.service is not None:
+            self.worker.submit(self.service.log_records, self.crn, records,
+                               on_error=lambda error: self.on_service_log_error(records, error))
+        else:
+            self.event_log.log_many(records)
 
-        log_path = os.path.join('./db', self.crn, 'event_log.txt')
-        with open(log_path, 'a') as log_file:
-            log_file.write(log_message)
+    # The service couldn't take the events, so they go to this kiosk's own log writer instead of being lost
+    def on_service_log_error(self, records, error):
+        self.event_log.log_many(records)
 
 
     # Open the registration window
@@ -211,39 +404,55 @@ class FaceRecognitionApp:
         if not username:
             util.msg_box("Error", "Username cannot be empty")
             return
+        if self.action_pending:
+            return
 
-        db_path = os.path.join(self.crn_directory_path, f'{username}.pkl')
+        self.set_busy("Registering\u2026")
+        self.worker.submit(self.register_face, username, self.most_recent_capture,
+                           on_done=self.on_registration_result, on_error=self.on_worker_error)
 
-        if os.path.exists(db_path):
-            util.msg_box("Error", f"Username {username} already exists.")
-            return
+    # Encode the captured face and save it unless the user is already registered (runs on the background worker)
+    # Returns the (title, message) to show to the user and whether the registration succeeded
+    def register_face(self, username, frame):
+        if username in util.get_face_gallery(self.crn):
+            return "Error", f"Username {username} already exists.", False
 
-        embeddings = face_recognition.face_encodings(self.most_recent_capture)
+        _, embeddings = util.detect_and_encode(frame, self.detection_scale, max_faces=1)
 
         if len(embeddings) == 0:
-            util.msg_box("Error", "No face found. Try again.")
-            return
+            return "Error", "No face found. Try again.", False
 
         closest_match = util.get_closest_match(embeddings[0], self.crn)
 
         if closest_match:
-            util.msg_box("Error", f"You are already registered as {closest_match}. Please log in.")
-            return
+            return "Error", f"You are already registered as {closest_match}. Please log in.", False
+
+        util.save_face_encoding(self.crn, username, embeddings[0])
 
-        with open(db_path, 'wb') as f:
-            pickle.dump(embeddings[0], f)
+        return "Success", f"{username} was successfully registered.", True
 
-        util.msg_box("Success", f"{username} was successfully registered.")
+    # Handle the result of a registration job
+    def on_registration_result(self, result):
+        title, message, registered = result
+        self.set_idle()
+        util.msg_box(title, message)
 
-        self.register_window.destroy()
+        if registered:
+            self.register_window.destroy()
 
 
     # Handle the window close event
     def destroy(self):
-        self.stop_webcam()
-        if self.cap is not None and self.cap.isOpened():
-            self.cap.release()
-        self.root.quit()
+        self.worker.shutdown()
+        try:
+            self.event_log.flush()
+        except Exception as e:
+            util.msg_box('Error', f'Some attendance records could not be saved: {e}')
+        finally:
+            self.stop_webcam()
+            if self.cap is not None and self.cap.isOpened():
+                self.cap.release()
+            self.root.quit()
 
 
 # Start the facial recognition window
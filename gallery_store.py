@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import pickle
+import threading
+import numpy as np
+import attendance_log
+
+DB_PATH = "./db"
+FACIAL_RECOGNITION_PATH = "facial_recognition"
+
+ENCODING_SIZE = 128
+ENCODING_DTYPE = np.float32
+ROW_BYTES = ENCODING_SIZE * np.dtype(ENCODING_DTYPE).itemsize
+
+DATA_FILENAME = "encodings.f32"
+INDEX_FILENAME = "names.json"
+FORMAT_VERSION = 2
+
+# Channel order of the frames a gallery's encodings were computed from. Frames are converted to RGB before
+# encoding (util.detect_and_encode); older kiosks passed OpenCV's BGR frames to face_recognition unchanged,
+# and those encodings are not comparable with the RGB ones, so recognition against them is unreliable.
+# Version 1 indexes and migrated pickles predate the conversion and are recorded as "bgr". Stale galleries
+# are listed by `python gallery_store.py --check`; re-enroll them by moving db/<crn>/facial_recognition aside
+# and registering the students again (e.g. with bulk_enroll.py).
+COLOR_ORDER = "rgb"
+LEGACY_COLOR_ORDER = "bgr"
+
+
+# Consolidated on-disk gallery for one CRN.
+# All encodings live in a single raw float32 file (row i is the i-th registered student) that can be
+# memory-mapped in one call, and names.json holds the names in row order. Registrations append a row
+# to the data file first and then atomically replace the index, so a crash mid-append leaves at most
+# a trailing partial row that the next writer truncates away.
+class GalleryStore:
+    _write_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_path = os.path.join(directory, DATA_FILENAME)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+
+    # True once the store has been created (by a registration or a migration)
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    # Return the names index, upgrading a version 1 index in memory (those galleries were encoded from BGR)
+    def read_index(self):
+        if not self.exists():
+            return {'version': FORMAT_VERSION, 'dim': ENCODING_SIZE, 'color_order': COLOR_ORDER, 'names': []}
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') not in (1, FORMAT_VERSION) or index.get('dim') != ENCODING_SIZE:
+            raise ValueError(f"Unsupported gallery index format in {self.index_path}")
+        index.setdefault('color_order', LEGACY_COLOR_ORDER)
+        return index
+
+    # Return the registered names in row order
+    def read_names(self):
+        return self.read_index()['names']
+
+    # Channel order of the frames the stored encodings were computed from
+    def color_order(self):
+        return self.read_index()['color_order']
+
+    # True when the encodings were computed from BGR frames and the students should be re-enrolled
+    def is_stale(self):
+        return self.color_order() != COLOR_ORDER
+
+    # Cheap fingerprint that changes whenever a registration is appended (each append atomically
+    # replaces the names index, which bumps the directory mtime) or a legacy pickle is dropped in
+    def signature(self):
+        try:
+            stat = os.stat(self.directory)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino
+
+    # Return (names, encodings) where encodings is a read-only (N, 128) memory map of the data file.
+    # Legacy per-student pickles found in the directory are migrated into the store first.
+    def load(self):
+        if self.legacy_pickles():
+            self.migrate_pickles()
+        names = self.read_names()
+        if not names:
+            return names, np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        encodings = np.memmap(self.data_path, dtype=ENCODING_DTYPE, mode='r', shape=(len(names), ENCODING_SIZE))
+        return names, encodings
+
+    # Atomically replace the names index
+    def _write_names(self, names, color_order):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': FORMAT_VERSION, 'dim': ENCODING_SIZE, 'color_order': color_order, 'names': names}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    # Append several (name, encoding) pairs in one write. color_order only applies to a new store; appending
+    # to an existing one keeps its recorded order, so a stale gallery stays flagged until it is re-enrolled.
+    def append_many(self, new_names, new_encodings, color_order=COLOR_ORDER):
+        new_names = list(new_names)
+        if not new_names:
+            return
+        rows = np.asarray(new_encodings, dtype=ENCODING_DTYPE).reshape(len(new_names), ENCODING_SIZE)
+
+        # The thread lock orders writers in this process; the file lock orders kiosks sharing the course
+        # directory, so one can't truncate or re-index rows another has just appended
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with attendance_log.FileLock(self.index_path):
+                self._append_locked(new_names, rows, color_order)
+
+    # append_many() with both locks held
+    def _append_locked(self, new_names, rows, color_order):
+        index = self.read_index()
+        names = index['names']
+        if self.exists():
+            color_order = index['color_order']
+        existing = set(names)
+        for name in new_names:
+            if name in existing:
+                raise ValueError(f"{name} is already registered.")
+            existing.add(name)
+
+        with open(self.data_path, 'ab') as f:
+            # Drop any rows left behind by an append that never made it into the index
+            f.truncate(len(names) * ROW_BYTES)
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._write_names(names + new_names, color_order)
+
+    # Append a single registration
+    def append(self, name, encoding):
+        self.append_many([name], [encoding])
+
+    # Names of the legacy per-student pickles in this directory
+    def legacy_pickles(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(filename for filename in os.listdir(self.directory) if filename.endswith('.pkl'))
+
+    # Convert legacy <name>.pkl files into the consolidated store; returns the number of students migrated
+    def migrate_pickles(self, remove=False):
+        registered = set(self.read_names())
+        names = []
+        encodings = []
+        pickle_files = self.legacy_pickles()
+        for filename in pickle_files:
+            name = filename[:-len('.pkl')]
+            if name in registered:
+                continue
+            with open(os.path.join(self.directory, filename), 'rb') as f:
+                encodings.append(np.asarray(pickle.load(f), dtype=ENCODING_DTYPE))
+            names.append(name)
+
+        # The pickles were written by kiosks that encoded BGR frames
+        self.append_many(names, encodings, LEGACY_COLOR_ORDER)
+
+        if remove:
+            for filename in pickle_files:
+                os.remove(os.path.join(self.directory, filename))
+
+        return len(names)
+
+
+# Every CRN directory under the database root. Dot-prefixed directories hold shared data (such as the campus
+# index deltas) and are never courses.
+def list_crns(db_path=DB_PATH):
+    if not os.path.isdir(db_path):
+        return []
+    return sorted(entry for entry in os.listdir(db_path)
+                  if not entry.startswith('.') and os.path.isdir(os.path.join(db_path, entry)))
+
+
+# One-shot migration of per-student pickles to the consolidated gallery format
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert db/<crn>/facial_recognition/*.pkl into the consolidated gallery format.")
+    parser.add_argument('crns', nargs='*', help="CRNs to migrate (default: every course under the database root)")
+    parser.add_argument('--db', default=DB_PATH, help="Database root directory")
+    parser.add_argument('--remove-pickles', action='store_true', help="Delete the .pkl files once migrated")
+    parser.add_argument('--check', action='store_true',
+                        help="Only list the galleries encoded from BGR frames, which need re-enrolling")
+    args = parser.parse_args(argv)
+
+    for crn in args.crns or list_crns(args.db):
+        store = GalleryStore(os.path.join(args.db, crn, FACIAL_RECOGNITION_PATH))
+        if not args.check:
+            migrated = store.migrate_pickles(remove=args.remove_pickles)
+            print(f"{crn}: migrated {migrated} student(s), {len(store.read_names())} registered")
+        if store.is_stale() or store.legacy_pickles():
+            print(f"{crn}: encoded from BGR frames, re-enroll the students "
+                  f"(move {store.directory} aside and register them again)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import argparse
+import os
+import struct
+import zipfile
+import numpy as np
+import attendance_log
+import log_index
+
+DB_PATH = "./db"
+ARCHIVE_DIRNAME = "archive"
+ARCHIVE_VERSION = 1
+
+
+# Files derived from the live log that have to be rebuilt once it is compacted
+def derived_filenames():
+    # Both build on storage, which imports this module
+    import presence_matrix
+    import reports
+    return [reports.REPORT_STATE_FILENAME, attendance_log.EVENT_LOG_FILENAME + log_index.INDEX_SUFFIX,
+            presence_matrix.PRESENCE_FILENAME]
+
+
+# Directory holding a course's archive segments
+def archive_directory(crn, db_path=DB_PATH):
+    return os.path.join(db_path, crn, ARCHIVE_DIRNAME)
+
+
+# Seconds since the epoch for "YYYY-MM-DD HH:MM:SS" timestamps (wall-clock time, no time zone), vectorized
+def to_epoch(timestamps):
+    return np.array([t.replace(' ', 'T') for t in timestamps], dtype='datetime64[s]').astype(np.int64)
+
+
+# Inverse of to_epoch
+def from_epoch(seconds):
+    return [str(t).replace('T', ' ') for t in np.asarray(seconds).astype('datetime64[s]')]
+
+
+# Dictionary-encode a column of strings: (sorted distinct values, int32 code per row)
+def encode_column(values):
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return dictionary, codes.astype(np.int32)
+
+
+# Map every member of an uncompressed .npz read-only. np.load ignores mmap_mode for .npz files, but members
+# written by np.savez are stored uncompressed, so each one is a plain .npy file at a known offset in the zip.
+def _memmap_npz(path):
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path} is compressed and can't be memory-mapped")
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            start = info.header_offset + 30 + name_length + extra_length
+            f.seek(start)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if len(shape) == 0 or 0 in shape:
+                # Scalars and empty arrays can't be mapped; they are tiny anyway
+                f.seek(start)
+                arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+# Columnar copy of a stretch of the event log: int64 epoch timestamps plus dictionary-encoded username, email
+# and action columns. Filters are vectorized comparisons over the columns; rows are only turned back into
+# AttendanceRecords for the matches.
+class ArchivedEvents:
+    def __init__(self, columns):
+        self.timestamps = columns['timestamps']
+        self.usernames = columns['usernames']
+        self.username_codes = columns['username_codes']
+        self.emails = columns['emails']
+        self.email_codes = columns['email_codes']
+        self.actions = columns['actions']
+        self.action_codes = columns['action_codes']
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_records(cls, records):
+        usernames, username_codes = encode_column([record.username for record in records])
+        emails, email_codes = encode_column([record.email for record in records])
+        actions, action_codes = encode_column([record.action for record in records])
+        return cls({'timestamps': to_epoch([record.timestamp for record in records]),
+                    'usernames': usernames, 'username_codes': username_codes,
+                    'emails': emails, 'email_codes': email_codes,
+                    'actions': actions, 'action_codes': action_codes.astype(np.uint8)})
+
+    # Write the columns as an .npz (uncompressed, so it can be memory-mapped, unless compress is set)
+    def save(self, path, compress=False):
+        tmp_path = path + '.tmp.npz'
+        save = np.savez_compressed if compress else np.savez
+        save(tmp_path, version=np.int32(ARCHIVE_VERSION), timestamps=self.timestamps,
+             usernames=self.usernames, username_codes=self.username_codes, emails=self.emails,
+             email_codes=self.email_codes, actions=self.actions, action_codes=self.action_codes)
+        os.replace(tmp_path, path)
+
+    # Memory-map a segment (compressed segments are read into memory instead)
+    @classmethod
+    def load(cls, path):
+        try:
+            columns = _memmap_npz(path)
+        except ValueError:
+            with np.load(path, allow_pickle=False) as data:
+                columns = {name: data[name] for name in data.files}
+        if int(columns['version']) != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported archive format in {path}")
+        return cls(columns)
+
+    # Boolean mask of the rows with since <= date <= until (YYYY-MM-DD, either may be None)
+    def mask_between(self, since=None, until=None):
+        mask = np.ones(len(self), dtype=bool)
+        if since:
+            mask &= self.timestamps >= to_epoch([since + " 00:00:00"])[0]
+        if until:
+            mask &= self.timestamps < to_epoch([until + " 00:00:00"])[0] + 86400
+        return mask
+
+    # Boolean mask of one student's rows
+    def mask_student(self, username):
+        code = np.searchsorted(self.usernames, username)
+        if code >= len(self.usernames) or self.usernames[code] != username:
+            return np.zeros(len(self), dtype=bool)
+        return self.username_codes == code
+
+    # The rows selected by a mask (every row if None) as AttendanceRecords
+    def records(self, mask=None):
+        rows = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        timestamps = from_epoch(self.timestamps[rows])
+        usernames = self.usernames[self.username_codes[rows]]
+        emails = self.emails[self.email_codes[rows]]
+        actions = self.actions[self.action_codes[rows]]
+        return [attendance_log.AttendanceRecord(*row) for row in zip(timestamps, usernames.tolist(),
+                                                                      emails.tolist(), actions.tolist())]
+
+
+# A course's archive segments, oldest first
+def list_segments(crn, db_path=DB_PATH):
+    directory = archive_directory(crn, db_path)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if filename.endswith('.npz') and not filename.endswith('.tmp.npz')]
+
+
+# Every archived segment of a course, memory-mapped, oldest first
+def load_segments(crn, db_path=DB_PATH):
+    return [ArchivedEvents.load(path) for path in list_segments(crn, db_path)]
+
+
+# Move the events before a date (YYYY-MM-DD) out of a course's event log into a new archive segment.
+# The log is rewritten under its lock, so kiosks appending meanwhile simply wait. Returns (archived, kept).
+def compact_log(crn, before, db_path=DB_PATH, compress=False):
+    log_path = attendance_log.event_log_path(crn, db_path)
+    with attendance_log.FileLock(log_path):
+        archived = []
+        kept = []
+        with open(log_path, 'r') as log:
+            for line in log:
+                record = attendance_log.parse_line(line)
+                if record is not None and record.timestamp[:10] < before:
+                    archived.append(record)
+                else:
+                    kept.append(line)
+        if not archived:
+            return 0, len(kept)
+
+        # Segments are named by the dates they cover, so sorting the names sorts them by age
+        directory = archive_directory(crn, db_path)
+        os.makedirs(directory, exist_ok=True)
+        first = min(record.timestamp for record in archived)[:10]
+        last = max(record.timestamp for record in archived)[:10]
+        segment_path = os.path.join(directory, f"events_{first}_{last}.npz")
+        suffix = 1
+        while os.path.exists(segment_path):
+            segment_path = os.path.join(directory, f"events_{first}_{last}_{suffix}.npz")
+            suffix += 1
+        ArchivedEvents.from_records(archived).save(segment_path, compress)
+
+        tmp_path = log_path + '.tmp'
+        with open(tmp_path, 'w') as log:
+            log.writelines(kept)
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(tmp_path, log_path)
+
+    for filename in derived_filenames():
+        try:
+            os.remove(os.path.join(db_path, crn, filename))
+        except FileNotFoundError:
+            pass
+    return len(archived), len(kept)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive old attendance events into columnar segments.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = subparsers.add_parser('compact', help="Move events before a date out of the live log")
+    compact_parser.add_argument('crn', help="Course registration number")
+    compact_parser.add_argument('--before', required=True, help="Archive events dated before YYYY-MM-DD")
+    compact_parser.add_argument('--compress', action='store_true',
+                                help="Compress the segment (smaller, but loaded into memory instead of mapped)")
+
+    stats_parser = subparsers.add_parser('stats', help="Show a course's archive segments")
+    stats_parser.add_argument('crn', help="Course registration number")
+
+    parser.add_argument('--db', default=DB_PATH, help="Database root directory")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact':
+        log_size = os.path.getsize(attendance_log.event_log_path(args.crn, args.db))
+        archived, kept = compact_log(args.crn, args.before, args.db, args.compress)
+        saved = log_size - os.path.getsize(attendance_log.event_log_path(args.crn, args.db))
+        print(f"Archived {archived} event(s) ({saved} bytes of log), {kept} line(s) left in the live log")
+    else:
+        for path in list_segments(args.crn, args.db):
+            events = ArchivedEvents.load(path)
+            print(f"{os.path.basename(path)}: {len(events)} event(s), {len(events.usernames)} student(s), "
+                  f"{os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    main()
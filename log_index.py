@@ -0,0 +1,225 @@
+import bisect
+import json
+import mmap
+import os
+import tempfile
+import attendance_log
+
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 2
+
+# Lines per sparse index block
+BLOCK_LINES = 256
+
+
+# Sparse index over an event log, kept next to it as <log>.idx.json and read through mmap.
+# The log is cut into blocks of BLOCK_LINES lines, and each block records its byte offset and the smallest and
+# largest timestamp in it. Kiosks append in small batches, so the log is only roughly in time order; a date
+# range query bisects the running maximum of the blocks to find where to start reading and stops once the
+# smallest timestamp of every later block is past the range. Each student also has a posting list of the blocks
+# holding their lines, so a student query reads only those blocks. The index is brought up to date
+# incrementally before each query, and saved only when a new block has been started: a process loading it
+# re-reads at most the lines added since, instead of every query rewriting the file.
+class LogIndex:
+    def __init__(self, log_path, block_lines=BLOCK_LINES):
+        self.log_path = log_path
+        self.index_path = log_path + INDEX_SUFFIX
+        self.block_lines = block_lines
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        self.offset = 0            # end of the last complete line indexed
+        self.last_line = ''        # that line, to detect a log rewritten under the index
+        self.block_offsets = []
+        self.block_min = []
+        self.block_max = []
+        self.block_count = 0       # lines in the last block
+        self.postings = {}         # username -> ids of the blocks holding their lines, ascending
+        self._saved_blocks = 0     # number of blocks when the index was last loaded or saved
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if state.get('version') != INDEX_VERSION or state.get('block_lines') != self.block_lines:
+            return
+        self.offset = state['offset']
+        self.last_line = state['last_line']
+        self.block_offsets = state['block_offsets']
+        self.block_min = state['block_min']
+        self.block_max = state['block_max']
+        self.block_count = state['block_count']
+        self.postings = state['postings']
+        self._saved_blocks = len(self.block_offsets)
+
+    # Atomically replace the saved index. The temporary file has a unique name, so processes updating the
+    # same index at once don't write into each other's; whichever replaces it last wins, and both are valid.
+    def _save(self):
+        state = {'version': INDEX_VERSION, 'block_lines': self.block_lines, 'offset': self.offset,
+                 'last_line': self.last_line, 'block_offsets': self.block_offsets, 'block_min': self.block_min,
+                 'block_max': self.block_max, 'block_count': self.block_count, 'postings': self.postings}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path) or '.', suffix=INDEX_SUFFIX)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._saved_blocks = len(self.block_offsets)
+
+    # True if the log still ends the indexed prefix with the line the index last saw
+    def _valid(self, log):
+        if not self.offset:
+            return True
+        last_line = self.last_line.encode('utf-8', errors='surrogateescape')
+        start = self.offset - len(last_line)
+        return 0 <= start and self.offset <= len(log) and log[start:self.offset] == last_line
+
+    # Index the lines appended since the last update (re-indexing from scratch if the log was rewritten)
+    def update(self):
+        with self._open() as log:
+            if log is None:
+                self._reset()
+                return
+            if not self._valid(log):
+                self._reset()
+            if self.offset == len(log):
+                return
+
+            offset = self.offset
+            while True:
+                end = log.find(b'\n', offset)
+                if end < 0:
+                    break   # a line still being appended; indexed next time
+                line = log[offset:end + 1].decode('utf-8', errors='surrogateescape')
+                record = attendance_log.parse_line(line)
+                if record is not None:
+                    self._add(offset, record)
+                self.last_line = line
+                offset = end + 1
+            self.offset = offset
+        if len(self.block_offsets) != self._saved_blocks:
+            self._save()
+
+    def _add(self, offset, record):
+        if not self.block_offsets or self.block_count >= self.block_lines:
+            self.block_offsets.append(offset)
+            self.block_min.append(record.timestamp)
+            self.block_max.append(record.timestamp)
+            self.block_count = 0
+        self.block_min[-1] = min(self.block_min[-1], record.timestamp)
+        self.block_max[-1] = max(self.block_max[-1], record.timestamp)
+        self.block_count += 1
+        blocks = self.postings.setdefault(record.username, [])
+        block = len(self.block_offsets) - 1
+        if not blocks or blocks[-1] != block:
+            blocks.append(block)
+
+    # mmap of the log, or None when it is missing or empty
+    def _open(self):
+        return _MappedLog(self.log_path)
+
+    # Records with since <= date <= until (YYYY-MM-DD, either may be None), in log order
+    def events_between(self, since=None, until=None):
+        self.update()
+        if not self.block_offsets:
+            return []
+
+        lower = since or ''
+        upper = (until + '~') if until else None   # '~' sorts after any time of day
+
+        # Running maximum: the first block that can hold a timestamp >= since
+        running_max = []
+        for value in self.block_max:
+            running_max.append(max(value, running_max[-1]) if running_max else value)
+        first = bisect.bisect_left(running_max, lower)
+
+        # Suffix minimum: once every later timestamp is past the range we can stop reading
+        end_block = len(self.block_offsets)
+        if upper is not None:
+            suffix_min = self.block_min[first:]
+            for i in range(len(suffix_min) - 2, -1, -1):
+                suffix_min[i] = min(suffix_min[i], suffix_min[i + 1])
+            end_block = first + bisect.bisect_right(suffix_min, upper)
+            # suffix_min is non-decreasing, so bisect_right finds the first block entirely after the range
+        if first >= end_block:
+            return []
+
+        records = []
+        with self._open() as log:
+            if log is None:
+                return []
+            start = self.block_offsets[first]
+            stop = self.block_offsets[end_block] if end_block < len(self.block_offsets) else self.offset
+            for line in log[start:stop].decode('utf-8', errors='replace').splitlines():
+                record = attendance_log.parse_line(line)
+                if record is not None and lower <= record.timestamp and (upper is None or record.timestamp < upper):
+                    records.append(record)
+        return records
+
+    # One student's records, optionally limited to since <= date <= until, in log order.
+    # Only the student's blocks whose timestamps overlap the range are read.
+    def events_for_student(self, username, since=None, until=None):
+        self.update()
+        blocks = self.postings.get(username, [])
+        lower = since or ''
+        upper = (until + '~') if until else None
+        records = []
+        with self._open() as log:
+            if log is None:
+                return []
+            for block in blocks:
+                if self.block_max[block] < lower or (upper is not None and self.block_min[block] >= upper):
+                    continue
+                start = self.block_offsets[block]
+                stop = self.block_offsets[block + 1] if block + 1 < len(self.block_offsets) else self.offset
+                for line in log[start:stop].decode('utf-8', errors='replace').splitlines():
+                    record = attendance_log.parse_line(line)
+                    if (record is not None and record.username == username and lower <= record.timestamp
+                            and (upper is None or record.timestamp < upper)):
+                        records.append(record)
+        return records
+
+    # Usernames that appear in the log
+    def usernames(self):
+        self.update()
+        return sorted(self.postings)
+
+
+# Context manager mapping a log read-only; yields None for a missing or empty file (which mmap can't map)
+class _MappedLog:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        try:
+            self._file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        if os.fstat(self._file.fileno()).st_size == 0:
+            return None
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._map is not None:
+            self._map.close()
+        if self._file is not None:
+            self._file.close()
+
+
+# The index for a log path, one per process
+_indexes = {}
+
+
+def get_log_index(log_path):
+    index = _indexes.get(log_path)
+    if index is None:
+        index = _indexes.setdefault(log_path, LogIndex(log_path))
+    return index
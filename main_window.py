@@ -1,12 +1,16 @@
-import os
 import tkinter as tk
 from tkinter import messagebox
 from choice_window import run_choice_window
 import util
+import storage
+import attendance_log
 import hashlib
-from openpyxl import Workbook
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from datetime import datetime
+from background_worker import BackgroundWorker
+import reports
+import presence_matrix
+import analytics
+from PIL import Image, ImageTk
 
 
 
@@ -15,6 +19,7 @@ class MainWindow:
     def __init__(self, root):
         self.root = root
         self.frame = None
+        self.report_worker = None   # background worker for report generation, created on first use
         self.show()
 
 
@@ -209,50 +214,67 @@ class MainWindow:
             messagebox.showerror("Error", "Please enter a valid CRN")
 
 
-    # Checks if the directory corresponding to the given CRN exists
+    # Checks if a course with the given CRN exists in storage
     def validate_crn(self, crn):
-        # Check if a directory named 'crn' exists
-        dir_path = f"./db/{crn}"
-        return os.path.exists(dir_path)
+        return bool(crn) and storage.get_storage().course_exists(crn)
 
-    # Reads attendance data and generates an attendance log in both Excel and PDF format
+    # Brings the attendance summary (Excel and PDF) up to date on a background thread.
+    # Only events logged since the last run are read.
     def generate_attendance_log(self, crn):
-        # Based on the CRN, fetch the correct directory and read the 'event_log.txt' file
-        # Then generate a pdf/excel based on its content.
-        # This assumes that each CRN has its own directory with 'event_log.txt' in it.
-        dir_path = f"./db/{crn}"
-        log_path = os.path.join(dir_path, "event_log.txt")
+        self.run_report_job(crn, reports.generate_course_reports, "Attendance summary updated")
 
-        if os.path.exists(log_path):
-            with open(log_path, "r") as log:
-                content = log.readlines()
+    # Exports every logged event to Excel and PDF on a background thread
+    def export_event_log(self, crn):
+        self.run_report_job(crn, reports.generate_event_listing, "Event log exported")
 
-                # Generating Excel Report
-                workbook = Workbook()
-                sheet = workbook.active
-
-                for index, line in enumerate(content, start=1):
-                    sheet.cell(row=index, column=1, value=line.strip())
-
-                excel_path = os.path.join(dir_path, "attendance_report.xlsx")
-                workbook.save(excel_path)
-
-                # Generating PDF Report
-                pdf_path = os.path.join(dir_path, "attendance_report.pdf")
-                c = canvas.Canvas(pdf_path, pagesize=letter)
-                width, height = letter
-
-                for index, line in enumerate(content, start=1):
-                    y_position = height - 50 - (15 * index)  # Adjust as per your requirements
-                    c.drawString(100, y_position, line.strip())
-
-                c.save()
-
-            messagebox.showinfo("Success", "Reports generated successfully!")
-
-
-        else:
+    # Runs job(crn, progress) on the report worker, showing its progress on the dashboard
+    def run_report_job(self, crn, job, done_message):
+        if not storage.get_storage().course_exists(crn):
             messagebox.showerror("Error", "No attendance log found for this CRN.")
+            return
+        if self.report_worker is None:
+            self.report_worker = BackgroundWorker(self.root)
+        if self.report_worker.busy():
+            return
+
+        # Kiosks in this process may still have events queued for the log
+        attendance_log.flush_all()
+
+        self.report_progress = 0
+        self.set_report_buttons_state('disabled')
+        self.report_status_label.config(text="Generating reports...")
+        self.report_worker.submit(job, crn, self.set_report_progress,
+                                  on_done=lambda count: self.on_reports_generated(count, done_message),
+                                  on_error=self.on_report_error)
+        self.show_report_progress()
+
+    def set_report_buttons_state(self, state):
+        if self.report_status_label.winfo_exists():
+            self.generate_button.config(state=state)
+            self.export_button.config(state=state)
+            self.analytics_button.config(state=state)
+
+    # Records how far report generation has got (called from the worker thread)
+    def set_report_progress(self, count):
+        self.report_progress = count
+
+    # Shows the report progress on the dashboard while the worker is busy
+    def show_report_progress(self):
+        if self.report_worker.busy() and self.report_status_label.winfo_exists():
+            self.report_status_label.config(text=f"Generating reports... {self.report_progress} events read")
+            self.root.after(200, self.show_report_progress)
+
+    def on_reports_generated(self, count, done_message):
+        self.set_report_buttons_state('normal')
+        if self.report_status_label.winfo_exists():
+            self.report_status_label.config(text=f"{done_message} ({count} events read).")
+        messagebox.showinfo("Success", "Reports generated successfully!")
+
+    def on_report_error(self, error):
+        self.set_report_buttons_state('normal')
+        if self.report_status_label.winfo_exists():
+            self.report_status_label.config(text="")
+        messagebox.showerror("Error", f"Report generation failed: {error}")
 
 
     # Collects class details from the form, hashes the password and stores the details
@@ -262,25 +284,15 @@ class MainWindow:
         email = self.email_entry.get("1.0", tk.END).strip()
         password = self.password_entry.get("1.0", tk.END).strip()
 
-        hashed_password = self.hash_password(password)
-
-        # Ensure the 'db' directory exists, create if not
-        if not os.path.exists('./db'):
-            os.mkdir('./db')
-
-        dir_path = f"./db/{crn}"
-        if not os.path.exists(dir_path):
-            os.mkdir(dir_path)
+        # CRNs name directories under db/; dot-prefixed names and path separators are reserved
+        if not crn or crn.startswith('.') or '/' in crn or '\\' in crn:
+            messagebox.showerror("Error", "Please enter a valid CRN")
+            return
 
-        # For now, we're storing details in a text file. This is NOT secure. It's for demonstration only.
-        with open(os.path.join(dir_path, "professor_details.txt"), "w") as f:
-            f.write(f"Course Name: {course_name}\n")
-            f.write(f"CRN: {crn}\n")
-            f.write(f"Email: {email}\n")
-            f.write(f"Password: {hashed_password}\n")  # Storing passwords as plain text is not safe!
+        hashed_password = self.hash_password(password)
 
-        with open(os.path.join(dir_path, "event_log.txt"), "w") as f:
-            pass
+        # For now, the file backend stores details in a text file. This is NOT secure. It's for demonstration only.
+        storage.get_storage().save_course(crn, course_name, email, hashed_password)
 
         messagebox.showinfo("Success", "Class details saved successfully!")
 
@@ -301,9 +313,143 @@ class MainWindow:
                                             fg_color='white', bg_color='black')
         welcome_label.pack(pady=20)
 
-        generate_button = util.get_button(self.frame, "Generate Attendance Log", color="#009966",
-                                          command=lambda: self.generate_attendance_log(crn), font_size=20)
-        generate_button.pack(pady=30)
+        overview_label = util.get_text_label(self.frame, self.attendance_overview(crn), font_size=16,
+                                             justify="center", fg_color='white', bg_color='black')
+        overview_label.pack(pady=10)
+
+        self.generate_button = util.get_button(self.frame, "Generate Attendance Log", color="#009966",
+                                               command=lambda: self.generate_attendance_log(crn), font_size=20)
+        self.generate_button.pack(pady=30)
+
+        self.export_button = util.get_button(self.frame, "Export Full Event Log", color="#0066cc",
+                                             command=lambda: self.export_event_log(crn), font_size=20)
+        self.export_button.pack(pady=10)
+
+        self.analytics_button = util.get_button(self.frame, "View Analytics", color="#cc6600",
+                                                command=lambda: self.show_analytics(crn), font_size=20)
+        self.analytics_button.pack(pady=10)
+
+        self.report_status_label = util.get_text_label(self.frame, "", font_size=16, justify="center",
+                                                       fg_color='white', bg_color='black')
+        self.report_status_label.pack(pady=10)
+
+        # Event log filters: a date range and/or a student
+        filter_frame = tk.Frame(self.frame, bg='black')
+        filter_frame.pack(pady=10)
+        self.filter_entries = {}
+        for key, text in (('since', "From (YYYY-MM-DD)"), ('until', "To"), ('username', "Student")):
+            label = util.get_text_label(filter_frame, text, font_size=14, fg_color='white', bg_color='black')
+            label.pack(side='left', padx=5)
+            entry = util.get_entry_text(filter_frame, height=1, width=12, font_size=14)
+            entry.pack(side='left', padx=5)
+            self.filter_entries[key] = entry
+        search_button = util.get_button(filter_frame, "Search", color="#0066cc",
+                                        command=lambda: self.search_events(crn), font_size=14, height=1, width=8)
+        search_button.pack(side='left', padx=10)
+
+        self.search_results = tk.Text(self.frame, height=12, width=90, font=("Courier", 12), state='disabled')
+        self.search_results.pack(pady=10)
+
+
+    # Looks up the events matching the dashboard filters on the report worker
+    def search_events(self, crn):
+        since, until, username = (self.filter_entries[key].get("1.0", tk.END).strip()
+                                  for key in ('since', 'until', 'username'))
+        for date in (since, until):
+            try:
+                if date:
+                    datetime.strptime(date, "%Y-%m-%d")
+            except ValueError:
+                messagebox.showerror("Error", "Dates must be entered as YYYY-MM-DD")
+                return
+        if self.report_worker is None:
+            self.report_worker = BackgroundWorker(self.root)
+
+        # Kiosks in this process may still have events queued for the log
+        attendance_log.flush_all()
+
+        backend = storage.get_storage()
+        if username:
+            query = lambda: backend.events_for_student(crn, username, since or None, until or None)
+        else:
+            query = lambda: backend.events_between(crn, since or None, until or None)
+        self.report_worker.submit(query, on_done=self.show_search_results, on_error=self.on_report_error)
+
+    # Fills the results box with the matching events (the most recent ones if there are many)
+    def show_search_results(self, records, limit=500):
+        if not self.search_results.winfo_exists():
+            return
+        shown = records[-limit:]
+        self.search_results.config(state='normal')
+        self.search_results.delete("1.0", tk.END)
+        header = f"{len(records)} matching events"
+        if len(records) > limit:
+            header += f" (showing the last {limit})"
+        self.search_results.insert(tk.END, header + "\n")
+        self.search_results.insert(tk.END, "".join(attendance_log.format_record(record) for record in shown))
+        self.search_results.config(state='disabled')
+
+
+    # Computes (or loads the cached) attendance charts on the report worker, then shows them.
+    # Like the report jobs, the buttons stay disabled (and clicks are ignored) until the job is done.
+    def show_analytics(self, crn):
+        if self.report_worker is None:
+            self.report_worker = BackgroundWorker(self.root)
+        if self.report_worker.busy():
+            return
+
+        # Kiosks in this process may still have events queued for the log
+        attendance_log.flush_all()
+
+        self.set_report_buttons_state('disabled')
+        self.report_status_label.config(text="Preparing analytics...")
+        self.report_worker.submit(analytics.get_analytics, crn,
+                                  on_done=lambda result: self.on_analytics_ready(crn, result),
+                                  on_error=self.on_report_error)
+
+    # Displays the attendance summary and charts in a new window
+    def on_analytics_ready(self, crn, result):
+        summary, chart_paths = result
+        self.set_report_buttons_state('normal')
+        if self.report_status_label.winfo_exists():
+            self.report_status_label.config(text="")
+
+        window = tk.Toplevel(self.root)
+        window.title(f"Attendance Analytics for CRN {crn}")
+        window.configure(bg='black')
+
+        summary_label = util.get_text_label(window, summary, font_size=14, justify="center",
+                                            fg_color='white', bg_color='black')
+        summary_label.pack(pady=10)
+
+        charts_frame = tk.Frame(window, bg='black')
+        charts_frame.pack(padx=10, pady=10)
+        window.chart_images = []   # PhotoImages must stay referenced while shown
+        for path in chart_paths:
+            photo = ImageTk.PhotoImage(Image.open(path))
+            window.chart_images.append(photo)
+            tk.Label(charts_frame, image=photo, bg='black').pack(side='left', padx=5)
+
+
+    # Summarises the course's attendance from its presence matrix (no log scan)
+    def attendance_overview(self, crn):
+        matrix = presence_matrix.get_presence_matrix(crn)
+        if not matrix.dates:
+            return "No attendance recorded yet."
+
+        rates = matrix.attendance_rates()
+        headcounts = matrix.headcounts()
+        lines = [f"{len(matrix.names)} students, {len(matrix.dates)} class days, "
+                 f"average attendance {100 * rates.mean():.0f}%",
+                 f"Last class ({matrix.dates[-1]}): {headcounts[-1]} present, "
+                 f"average headcount {headcounts.mean():.1f}"]
+
+        absentees = matrix.chronic_absentees()
+        if absentees:
+            shown = ", ".join(f"{name} ({100 * rate:.0f}%)" for name, rate in absentees[:5])
+            more = f" and {len(absentees) - 5} more" if len(absentees) > 5 else ""
+            lines.append(f"Chronically absent: {shown}{more}")
+        return "\n".join(lines)
 
 
     # Validates the credentials entered by the professor and logs them in if they're correct
@@ -323,24 +469,21 @@ class MainWindow:
     # Checks the given professor's credentials against the saved data
     def check_professor_credentials(self, crn, email, password):
 
-        dir_path = f"./db/{crn}"
-        prof_details_path = os.path.join(dir_path, "professor_details.txt")
+        course = storage.get_storage().get_course(crn)
 
-        if not os.path.exists(prof_details_path):
+        if course is None:
             return False
 
-        with open(prof_details_path, "r") as file:
-            lines = file.readlines()
-            saved_email = lines[2].split(":")[1].strip()  # Extract email from the saved details
-            saved_hashed_password = lines[3].split(":")[1].strip()  # Extract hashed password
+        saved_email = course['email']
+        saved_hashed_password = course['password_hash']
 
-            hashed_input_password = self.hash_password(password).strip()
+        hashed_input_password = self.hash_password(password).strip()
 
-            print(f"Saved Email: {saved_email}, Saved Hashed Password: {saved_hashed_password}")  # Debugging statement
+        print(f"Saved Email: {saved_email}, Saved Hashed Password: {saved_hashed_password}")  # Debugging statement
 
 
-            if email == saved_email:
-                return True
+        if email == saved_email:
+            return True
 
         print("fail")
 
@@ -0,0 +1,129 @@
+import json
+import os
+import numpy as np
+import attendance_log
+import storage
+
+PRESENCE_FILENAME = "presence.npz"
+
+# Students below this attendance rate are listed as chronically absent
+CHRONIC_ABSENCE_RATE = 0.9
+
+
+# Path of a course's presence matrix
+def presence_path(crn, db_path=storage.DB_PATH):
+    return os.path.join(db_path, crn, PRESENCE_FILENAME)
+
+
+# Student x class-day presence matrix for one course: presence[i, j] is 1 if names[i] checked in on dates[j].
+# Dates are kept sorted and class days are the dates on which anyone checked in, so every dashboard number
+# is a reduction over a small uint8 array rather than a scan of the log. checkpoint is the storage backend's
+# checkpoint of the last event folded in (None before the first), as used by the report aggregates.
+class PresenceMatrix:
+    def __init__(self, names=(), dates=(), presence=None, checkpoint=None):
+        self.names = list(names)
+        self.dates = list(dates)
+        self.presence = presence if presence is not None else np.zeros((len(self.names), len(self.dates)), dtype=np.uint8)
+        self.checkpoint = checkpoint
+        self._rows = {name: i for i, name in enumerate(self.names)}
+
+    # Mark the check-ins among the records
+    def add_records(self, records):
+        present = [(record.username, storage.event_date(record.timestamp))
+                   for record in records if record.action == 'Present']
+        if not present:
+            return
+
+        new_names = sorted({name for name, _ in present} - self._rows.keys())
+        if new_names:
+            for name in new_names:
+                self._rows[name] = len(self.names)
+                self.names.append(name)
+            self.presence = np.vstack([self.presence,
+                                       np.zeros((len(new_names), len(self.dates)), dtype=np.uint8)])
+
+        new_dates = sorted({date for _, date in present} - set(self.dates))
+        if new_dates:
+            # Class days almost always arrive in order, so this is normally an append of new columns
+            positions = np.searchsorted(np.array(self.dates, dtype=str), new_dates)
+            self.presence = np.insert(self.presence, positions, 0, axis=1)
+            self.dates = sorted(self.dates + new_dates)
+
+        columns = {date: j for j, date in enumerate(self.dates)}
+        rows = np.fromiter((self._rows[name] for name, _ in present), dtype=np.int64, count=len(present))
+        cols = np.fromiter((columns[date] for _, date in present), dtype=np.int64, count=len(present))
+        self.presence[rows, cols] = 1
+
+    # Fraction of class days each student attended, in names order
+    def attendance_rates(self):
+        if not self.dates:
+            return np.zeros(len(self.names))
+        return self.presence.sum(axis=1) / len(self.dates)
+
+    # Number of students present on each class day, in dates order
+    def headcounts(self):
+        return self.presence.sum(axis=0, dtype=np.int64)
+
+    # (name, rate) of the students attending less than the threshold, lowest first
+    def chronic_absentees(self, threshold=CHRONIC_ABSENCE_RATE):
+        rates = self.attendance_rates()
+        order = np.argsort(rates, kind='stable')
+        return [(self.names[i], float(rates[i])) for i in order if rates[i] < threshold]
+
+    # Atomically replace the saved matrix
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, names=np.array(self.names, dtype=str), dates=np.array(self.dates, dtype=str),
+                 presence=self.presence, checkpoint=np.array(json.dumps(self.checkpoint)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            # Matrices saved before checkpoints were recorded have none, so they are rebuilt once
+            checkpoint = json.loads(str(data['checkpoint'])) if 'checkpoint' in data.files else None
+            return cls(data['names'].tolist(), data['dates'].tolist(), data['presence'], checkpoint)
+
+
+# Fold the events logged since a matrix's checkpoint into it, advancing the checkpoint; returns the number read
+def catch_up(matrix, backend, crn):
+    count = 0
+    batch = []
+    for record, checkpoint in backend.iter_events_since(crn, matrix.checkpoint):
+        batch.append(record)
+        matrix.checkpoint = checkpoint
+        count += 1
+        if len(batch) >= 10000:
+            matrix.add_records(batch)
+            batch = []
+    matrix.add_records(batch)
+    return count
+
+
+# Build a course's matrix from its whole attendance log
+def build_presence_matrix(crn, db_path=storage.DB_PATH):
+    matrix = PresenceMatrix()
+    catch_up(matrix, storage.storage_for(db_path), crn)
+    return matrix
+
+
+# The saved matrix for a course, first brought up to date with the log. Like the report aggregates, only the
+# events after the saved checkpoint are read, and the matrix is rebuilt when the log no longer contains the
+# checkpoint (it was truncated, rewritten or compacted) or it has none. The attendance log writer calls this
+# after each batch it commits; if one of those updates fails, the events it missed are read on the next call.
+# The update is done under a file lock so kiosks sharing the course don't lose each other's.
+def get_presence_matrix(crn, db_path=storage.DB_PATH):
+    backend = storage.storage_for(db_path)
+    path = presence_path(crn, db_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with attendance_log.FileLock(path):
+        try:
+            matrix = PresenceMatrix.load(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            matrix = None
+        if matrix is None or matrix.checkpoint is None or not backend.checkpoint_valid(crn, matrix.checkpoint):
+            matrix = build_presence_matrix(crn, db_path)
+            matrix.save(path)
+        elif catch_up(matrix, backend, crn):
+            matrix.save(path)
+        return matrix
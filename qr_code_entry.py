@@ -1,13 +1,18 @@
+import io
 import os
 import tkinter as tk
+from collections import OrderedDict
 from tkinter import messagebox, simpledialog
 import cv2
-import qrcode
 from PIL import Image, ImageTk
-from pyzbar.pyzbar import decode
 import util
-from datetime import datetime
-import json
+from qr_scanner import QRScanWorker, QRScanCache
+import qr_payload
+import attendance_log
+import storage
+import recognition_client
+from background_worker import BackgroundWorker
+import time
 
 class QRCodeEntryApp:
     def __init__(self, root, crn):
@@ -16,7 +21,7 @@ class QRCodeEntryApp:
         # Define paths for database and QR code directory
         self.crn_directory_path = f"./db/{crn}"
         self.qr_code_directory = f"{self.crn_directory_path}/qr_codes"
-        self.event_log_path = f"{self.crn_directory_path}/event_log.txt"
+        self.event_log = attendance_log.get_writer(crn)
 
         # Create directory for QR codes if not exists
         if not os.path.exists(self.qr_code_directory):
@@ -28,6 +33,31 @@ class QRCodeEntryApp:
         self.root.configure(bg='black')
         self.root.protocol("WM_DELETE_WINDOW", self.destroy)
 
+        # QR codes are decoded on a background thread fed with the newest frame
+        self.scanner = QRScanWorker(decode_interval=0.1, decode_scale=0.5)
+        self.scanner.start()
+        self.last_detections = []     # boxes of the most recently decoded codes, drawn on the preview
+        self.last_detection_time = 0
+
+        # Compact QR codes carry only a student ID, resolved through the course roster held in memory
+        self.roster = storage.get_storage().roster(crn)
+
+        # Parsed payloads are cached per code, and a code seen again within checkin_window seconds is not re-logged
+        self.checkin_window = 300
+        self.scan_cache = QRScanCache(lambda data: qr_payload.parse_payload(data, self.roster),
+                                      log_window=self.checkin_window)
+
+        # With ATTENDANCE_SERVICE_URL set, check-ins go to the shared recognition service instead
+        self.crn = crn
+        self.service = recognition_client.get_client()
+        self.worker = BackgroundWorker(self.root) if self.service is not None else None
+        self.checkins_in_flight = set()
+        self.status_clear_job = None
+
+        # Display-ready QR images for "Retrieve QR", least recently used evicted first
+        self.qr_photo_cache = OrderedDict()
+        self.qr_photo_cache_size = 256
+
         # Initialize UI elements and webcam
         self.initialize_ui()
         self.start_webcam()
@@ -39,6 +69,10 @@ class QRCodeEntryApp:
         self.webcam_label.config(width=640, height=400)
         self.webcam_label.pack(pady=10)
 
+        # Non-blocking check-in confirmation shown under the preview
+        self.status_label = util.get_text_label(self.root, "", font_size=18, fg_color='lime green')
+        self.status_label.pack()
+
         # Create and set up the 'Register' button
         self.register_button = util.get_button(self.root, 'Register', 'gray', self.register)
         self.register_button.pack(pady=10)
@@ -60,33 +94,34 @@ class QRCodeEntryApp:
             return
         self.process_webcam()
 
-    # Capture and process frames from the webcam
+    # Capture frames from the webcam, hand them to the decoder thread and handle any decoded QR codes
     def process_webcam(self):
         ret, frame = self.cap.read()
-        self.most_recent_capture = frame
-        qr_info = decode(frame)
-
-        detected = False    # initialize the detected flag
 
         if not ret:
             return
 
-        # Check if a QR code is detected in the frame
-        for qr in qr_info:
-            data = qr.data.decode('utf-8')
+        self.most_recent_capture = frame
+        self.scanner.submit_frame(frame)
 
-            try:
-                cleaned_data = data.replace("'", '"')
-                self.data = json.loads(cleaned_data) #parse the cleaned JSON string into a dictionary
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON: {e}")
-                print(f"Received data: {data}")
-                return
+        detections = self.scanner.poll()
+        if detections:
+            self.last_detections = detections
+            self.last_detection_time = time.monotonic()
+        elif time.monotonic() - self.last_detection_time > 0.5:
+            self.last_detections = []
 
-            # Highlight the QR code area
-            rect = qr.rect
-            frame = cv2.rectangle(frame, (rect.left, rect.top),
-                                  (rect.left + rect.width, rect.top + rect.height), (0, 255, 0), 2)
+        # Check if a QR code is detected in the frame
+        for qr in detections:
+            # The local cache also filters what goes to the service: a code held in front of the camera is
+            # only sent once per check-in window rather than for every frame it is decoded in
+            self.data = self.scan_cache.lookup(qr.data)
+            if self.data is None or not self.scan_cache.should_log(qr.data):
+                continue
+
+            if self.service is not None:
+                self.submit_checkin(qr.data)
+                continue
 
             # Extract user info and log the attendance
             username = self.data.get('username', 'Unknown')
@@ -94,17 +129,22 @@ class QRCodeEntryApp:
 
             #record attendance
             self.log_event(username, email, 'Present')
-            messagebox.showinfo('QR Code Detected', f'Welcome {username}, attendance marked!')
-
-            detected = True    # mark that a QR code was detected
+            self.show_status(f'Welcome {username}, attendance marked!')
 
             self.reset_for_next_login()     # reset for next login
 
-
         # Display the processed frame in the UI
         img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         img_rgb = cv2.resize(img_rgb, (640, 480))
 
+        # Highlight the QR code area (on the preview copy; the decoder thread may still be reading frame)
+        scale_x = img_rgb.shape[1] / frame.shape[1]
+        scale_y = img_rgb.shape[0] / frame.shape[0]
+        for qr in self.last_detections:
+            left, top, width, height = qr.rect
+            cv2.rectangle(img_rgb, (int(left * scale_x), int(top * scale_y)),
+                          (int((left + width) * scale_x), int((top + height) * scale_y)), (0, 255, 0), 2)
+
         img_pil = Image.fromarray(img_rgb)
         imgtk = ImageTk.PhotoImage(image=img_pil)
 
@@ -115,6 +155,39 @@ class QRCodeEntryApp:
         self.webcam_label.after(10, self.process_webcam)
 
 
+    # Check a code in through the recognition service (which resolves, debounces and logs it for every kiosk).
+    # A code is only sent again once the previous request for it has answered.
+    def submit_checkin(self, data):
+        if data in self.checkins_in_flight:
+            return
+        self.checkins_in_flight.add(data)
+        self.worker.submit(self.service.qr_checkin, self.crn, data,
+                           on_done=lambda result: self.on_checkin_result(data, result),
+                           on_error=lambda error: self.on_checkin_error(data, error))
+
+    def on_checkin_result(self, data, result):
+        self.checkins_in_flight.discard(data)
+        student, logged = result
+        if logged:
+            self.show_status(f"Welcome {student.get('username', 'Unknown')}, attendance marked!")
+
+    def on_checkin_error(self, data, error):
+        self.checkins_in_flight.discard(data)
+        # Not checked in after all, so the next sighting of the code tries again
+        self.scan_cache.forget_logged(data)
+        self.show_status(f"Check-in failed: {error}")
+
+    # Show a confirmation under the preview for a few seconds without blocking the scan loop
+    def show_status(self, message, duration=3000):
+        self.status_label.config(text=message)
+        if self.status_clear_job is not None:
+            self.root.after_cancel(self.status_clear_job)
+        self.status_clear_job = self.root.after(duration, self.clear_status)
+
+    def clear_status(self):
+        self.status_clear_job = None
+        self.status_label.config(text="")
+
     # Reset data for the next login attempt
     def reset_for_next_login(self):
         self.data = {}
@@ -125,15 +198,41 @@ class QRCodeEntryApp:
         self.cap.release()
 
 
-    # Display a given QR code image in a new window, once registered
-    def show_qr_code(self, img_path):
+    # Return a display-ready (300x300) PhotoImage of a student's QR code, or None if they are not registered.
+    # Images are kept in an LRU cache keyed by email; on a miss the stored PNG is used if present, otherwise the
+    # code is regenerated from the student's roster entry, so the PNG directory is optional.
+    def get_qr_photo(self, email):
+        photo = self.qr_photo_cache.get(email)
+        if photo is not None:
+            self.qr_photo_cache.move_to_end(email)
+            return photo
+
+        img_path = f"{self.qr_code_directory}/{email}.png"
+        student = self.roster.get_by_email(email)
+        if os.path.exists(img_path):
+            img = Image.open(img_path)
+        elif student is not None:
+            img = Image.open(io.BytesIO(qr_payload.render_qr_png(qr_payload.encode_compact(student['student_id']))))
+        else:
+            return None
+
+        # QR modules are hard-edged blocks, so nearest-neighbour resampling keeps them sharp
+        photo = ImageTk.PhotoImage(img.convert('RGB').resize((300, 300), Image.NEAREST))
+
+        self.qr_photo_cache[email] = photo
+        if len(self.qr_photo_cache) > self.qr_photo_cache_size:
+            self.qr_photo_cache.popitem(last=False)
+        return photo
+
+    # Display a student's QR code in a new window, once registered
+    def show_qr_code(self, email):
+        img = self.get_qr_photo(email)
+        if img is None:
+            return
+
         new_window = tk.Toplevel(self.root)
         new_window.title("Your QR Code")
 
-        img = Image.open(img_path)
-        img = img.resize((300, 300), Image.ANTIALIAS)
-        img = ImageTk.PhotoImage(img)
-
         label = tk.Label(new_window, image=img)
         label.image = img
         label.pack()
@@ -171,42 +270,33 @@ class QRCodeEntryApp:
         email = self.email_entry.get("1.0", 'end-1c').strip()
 
         if username and email:
-            # check if this email is already registered
+            # check if this email is already registered (codes issued before the roster existed only have a PNG)
             img_path = f"{self.qr_code_directory}/{email}.png"
 
-            if os.path.exists(img_path):
+            if email in self.roster or os.path.exists(img_path):
                 messagebox.showwarning('Registration Failed', f'Email {email} is already registered.')
                 return
 
-            # Generate the QR code for the new registration
-            qr_data = {
-                "username": username,
-                "email": email
-            }
-
-            json_str = json.dumps(qr_data)
+            # Generate a compact QR code holding only the new student's roster ID
+            try:
+                student = self.roster.add(username, email)
+            except ValueError:
+                # another kiosk registered this email after the check above
+                messagebox.showwarning('Registration Failed', f'Email {email} is already registered.')
+                return
 
-            self.generate_qr_code(json_str, img_path)
+            self.generate_qr_code(qr_payload.encode_compact(student['student_id']), img_path)
 
             messagebox.showinfo('Registration Successful', f'Registered as {username}. QR code saved at {img_path}')
 
-            self.show_qr_code(img_path)
+            self.show_qr_code(email)
 
             self.register_window.destroy()
 
 
-    def generate_qr_code(self, json_str, img_path):
-        # Generate a QR code image from a given JSON string
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(json_str)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill='black', back_color='white')
+    def generate_qr_code(self, payload, img_path):
+        # Generate a QR code image from a given payload string
+        img = qr_payload.make_qr_image(payload)
 
         img.save(img_path)
 
@@ -217,29 +307,31 @@ class QRCodeEntryApp:
         if not email:
             return
 
-        img_path = f"{self.qr_code_directory}/{email}.png"
-
-        if not os.path.exists(img_path):
+        if self.get_qr_photo(email) is None:
             messagebox.showwarning('Retrieve QR', 'QR code not found.')
             return
 
-        self.show_qr_code(img_path)
+        self.show_qr_code(email)
 
-    # Logs the given event (user action) to the event log file with a timestamp.
+    # Logs the given event (user action) to the event log with a timestamp, through the shared group-commit writer.
     def log_event(self, username, email, action):
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_message = f"{current_time}, {username}, {email}, {action}\n"
-
-        with open(self.event_log_path, 'a') as log_file:
-            log_file.write(log_message)
+        self.event_log.log(attendance_log.make_record(username, action, email=email))
 
 
     #Closes the application safely, ensuring the webcam is released and the Tkinter main loop is stopped.
     def destroy(self):
-        self.stop_webcam()
-        if self.cap is not None and self.cap.isOpened():
-            self.cap.release()
-        self.root.quit()
+        self.scanner.stop()
+        if self.worker is not None:
+            self.worker.shutdown()
+        try:
+            self.event_log.flush()
+        except Exception as e:
+            util.msg_box('Error', f'Some attendance records could not be saved: {e}')
+        finally:
+            self.stop_webcam()
+            if self.cap is not None and self.cap.isOpened():
+                self.cap.release()
+            self.root.quit()
 
 #Initializes and runs the main window for the QR Code Entry application
 def run_qr_code_entry_window(crn):
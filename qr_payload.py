@@ -0,0 +1,188 @@
+import csv
+import io
+import json
+import os
+import threading
+import qrcode
+import attendance_log
+
+# Characters of the QR alphanumeric mode; payloads built only from these encode at 5.5 bits per character
+ALPHANUMERIC = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:"
+BASE36 = ALPHANUMERIC[:36]
+
+COMPACT_PREFIX = "CA1:"     # "class attendance", payload version 1
+STUDENT_ID_LENGTH = 5       # base36 digits, about 60 million students per course
+
+ROSTER_FILENAME = "roster.csv"
+ROSTER_FIELDS = ['student_id', 'username', 'email']
+
+
+# Base36 check character over the ID digits (position-weighted, so swapped digits are caught too)
+def check_character(student_id):
+    total = sum((position + 1) * BASE36.index(char) for position, char in enumerate(student_id))
+    return BASE36[total % 36]
+
+
+# Fixed-width base36 student ID for a roster sequence number
+def format_student_id(number):
+    digits = ""
+    for _ in range(STUDENT_ID_LENGTH):
+        number, remainder = divmod(number, 36)
+        digits = BASE36[remainder] + digits
+    if number:
+        raise ValueError("Student number does not fit in a compact ID")
+    return digits
+
+
+# Roster sequence number of a student ID (inverse of format_student_id)
+def parse_student_id(student_id):
+    return int(student_id, 36)
+
+
+# Compact QR payload for a student ID, e.g. "CA1:0000AK"; it fits in a version 1 code
+def encode_compact(student_id):
+    return f"{COMPACT_PREFIX}{student_id}{check_character(student_id)}"
+
+
+# Student ID in a compact payload, or None if the text is not a valid compact payload
+def decode_compact(text):
+    if not text.startswith(COMPACT_PREFIX):
+        return None
+    body = text[len(COMPACT_PREFIX):]
+    if len(body) != STUDENT_ID_LENGTH + 1 or any(char not in BASE36 for char in body):
+        return None
+    student_id, check = body[:-1], body[-1]
+    if check_character(student_id) != check:
+        return None
+    return student_id
+
+
+# Build the QR code image for a payload string. Compact payloads are uppercase alphanumeric,
+# so qrcode encodes them in alphanumeric mode and they fit in a version 1 code.
+def make_qr_image(payload, box_size=10, border=4):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr.make_image(fill='black', back_color='white')
+
+
+# PNG bytes of the QR code for a payload (picklable, so it can run in a worker process)
+def render_qr_png(payload):
+    buffer = io.BytesIO()
+    make_qr_image(payload).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# Legacy {"username": ..., "email": ...} payloads. Older codes were written with single quotes, so those
+# are retried as JSON after swapping the quotes.
+def parse_legacy(text):
+    for candidate in (text, text.replace("'", '"')):
+        try:
+            payload = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(payload, dict):
+            return payload
+    return None
+
+
+# Parse scanned QR bytes into {"username", "email"} (plus "student_id" for compact codes), or None.
+# Compact codes are resolved through the course roster; legacy JSON codes carry the details themselves.
+def parse_payload(data, roster):
+    text = data.decode('utf-8', errors='replace')
+    student_id = decode_compact(text)
+    if student_id is not None:
+        return roster.get(student_id)
+    return parse_legacy(text)
+
+
+# The students of one course who registered for QR check-in, held in memory and backed by db/<crn>/roster.csv.
+# The file is re-read when another kiosk has appended to it since it was last loaded.
+class Roster:
+    def __init__(self, crn_directory_path):
+        self.path = os.path.join(crn_directory_path, ROSTER_FILENAME)
+        self.by_id = {}
+        self.by_email = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    # Re-read the roster file if it changed on disk
+    def reload(self):
+        with self._lock:
+            self._reload()
+
+    # reload() with self._lock already held
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        by_id = {}
+        by_email = {}
+        with open(self.path, newline='') as f:
+            for row in csv.DictReader(f):
+                entry = {'student_id': row['student_id'], 'username': row['username'], 'email': row['email']}
+                by_id[entry['student_id']] = entry
+                by_email[entry['email']] = entry
+        self.by_id, self.by_email, self._mtime = by_id, by_email, mtime
+
+    # Student details for an ID, or None if unknown
+    def get(self, student_id):
+        entry = self.by_id.get(student_id)
+        if entry is None:
+            self.reload()
+            entry = self.by_id.get(student_id)
+        return entry
+
+    # Student details for an email, or None if not registered
+    def get_by_email(self, email):
+        entry = self.by_email.get(email)
+        if entry is None:
+            self.reload()
+            entry = self.by_email.get(email)
+        return entry
+
+    def __contains__(self, email):
+        return email in self.by_email
+
+    # Register a student under the next free ID and return their details
+    def add(self, username, email):
+        return self.add_many([(username, email)])[0]
+
+    # Register several (username, email) pairs with one append to the roster file; returns their details.
+    # The file lock is held from re-reading the roster to appending, so kiosks registering at the same time
+    # never hand out the same ID; IDs continue from the highest one in the file, not the row count.
+    def add_many(self, students):
+        with attendance_log.FileLock(self.path), self._lock:
+            self._reload()
+            seen = set()
+            for _, email in students:
+                if email in self.by_email or email in seen:
+                    raise ValueError(f"Email {email} is already registered.")
+                seen.add(email)
+
+            next_number = max((parse_student_id(student_id) for student_id in self.by_id), default=0) + 1
+            entries = [{'student_id': format_student_id(next_number + i), 'username': username, 'email': email}
+                       for i, (username, email) in enumerate(students)]
+
+            new_file = not os.path.exists(self.path)
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=ROSTER_FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(entries)
+
+            # Only now that the rows are on disk; nobody else can have written since the reload above
+            for entry in entries:
+                self.by_id[entry['student_id']] = entry
+                self.by_email[entry['email']] = entry
+            self._mtime = os.stat(self.path).st_mtime_ns
+        return entries
@@ -0,0 +1,160 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+import cv2
+from pyzbar.pyzbar import decode
+
+# A decoded QR code: the raw payload bytes and its (left, top, width, height) box in full-frame coordinates
+QRDetection = namedtuple('QRDetection', ['data', 'rect'])
+
+
+# Decodes QR codes on a background thread so the Tk preview never waits for pyzbar.
+# The UI drops each new frame into a single latest-frame slot (older undecoded frames are simply replaced),
+# and the thread decodes at most once per decode_interval on a grayscale, downscaled copy. After a hit,
+# the next decodes first try a full-resolution crop around the last code, which is far smaller than the frame.
+class QRScanWorker(threading.Thread):
+    def __init__(self, decode_interval=0.1, decode_scale=0.5, roi_margin=0.5):
+        super().__init__(name='qr-scan-worker', daemon=True)
+        self.decode_interval = decode_interval   # minimum seconds between two decodes
+        self.decode_scale = decode_scale         # size of the full-frame decode copy relative to the frame
+        self.roi_margin = roi_margin             # padding around the last code, as a fraction of its size
+        self.results = queue.Queue()
+        self._frame = None
+        self._condition = threading.Condition()
+        self._running = True
+        self._last_rect = None
+
+    # Offer the newest camera frame for decoding (called from the Tk thread)
+    def submit_frame(self, frame):
+        with self._condition:
+            self._frame = frame
+            self._condition.notify()
+
+    # Return every detection list produced since the last call, without blocking
+    def poll(self):
+        detections = []
+        while True:
+            try:
+                detections.extend(self.results.get_nowait())
+            except queue.Empty:
+                return detections
+
+    # Ask the thread to exit after its current decode
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        last_decode = 0.0
+        while True:
+            with self._condition:
+                while self._running and self._frame is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                frame, self._frame = self._frame, None
+
+            wait = self.decode_interval - (time.monotonic() - last_decode)
+            if wait > 0:
+                time.sleep(wait)
+                # A newer frame may have arrived while waiting
+                with self._condition:
+                    if self._frame is not None:
+                        frame, self._frame = self._frame, None
+            last_decode = time.monotonic()
+
+            detections = self.scan(frame)
+            if detections:
+                self.results.put(detections)
+
+    # Decode one BGR frame: region-of-interest fast path first, then the downscaled full frame
+    def scan(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        if self._last_rect is not None:
+            detections = self._scan_roi(gray, self._last_rect)
+            if detections:
+                self._last_rect = detections[0].rect
+                return detections
+
+        detections = self._scan_full(gray)
+        self._last_rect = detections[0].rect if detections else None
+        return detections
+
+    def _scan_roi(self, gray, rect):
+        left, top, width, height = rect
+        pad_x, pad_y = int(width * self.roi_margin), int(height * self.roi_margin)
+        x0, y0 = max(0, left - pad_x), max(0, top - pad_y)
+        x1, y1 = min(gray.shape[1], left + width + pad_x), min(gray.shape[0], top + height + pad_y)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        return [QRDetection(code.data, (code.rect.left + x0, code.rect.top + y0, code.rect.width, code.rect.height))
+                for code in decode(gray[y0:y1, x0:x1])]
+
+    def _scan_full(self, gray):
+        scale = self.decode_scale
+        if scale >= 1.0:
+            small = gray
+        else:
+            small = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return [QRDetection(code.data, (int(code.rect.left / scale), int(code.rect.top / scale),
+                                        int(code.rect.width / scale), int(code.rect.height / scale)))
+                for code in decode(small)]
+
+
+# In-memory TTL cache keyed by raw QR payload bytes.
+# Remembers the parsed payload so a code held in front of the camera is parsed once, and when it was last
+# logged so repeated sightings within log_window seconds don't write the same check-in again.
+# A payload that fails to parse is only remembered for negative_ttl seconds, so a student registered right
+# after showing their code is recognized on the next attempt.
+class QRScanCache:
+    def __init__(self, parse, ttl=600, log_window=300, negative_ttl=5):
+        self.parse = parse              # function turning the payload bytes into a dict, or None if invalid
+        self.ttl = ttl                  # seconds a parsed payload is kept after it was last seen
+        self.log_window = log_window    # seconds during which a repeated check-in is suppressed
+        self.negative_ttl = negative_ttl  # seconds before an unrecognized payload is parsed again
+        self._entries = {}              # payload bytes -> [parsed payload, last seen, last logged, parsed at]
+        self._next_sweep = 0.0
+
+    # Parsed payload for these bytes, parsing only on a cache miss or once a negative result expired
+    def lookup(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        self._sweep(now)
+        entry = self._entries.get(data)
+        if entry is None:
+            entry = [self.parse(data), now, None, now]
+            self._entries[data] = entry
+        elif entry[0] is None and now - entry[3] >= self.negative_ttl:
+            entry[0] = self.parse(data)
+            entry[3] = now
+        entry[1] = now
+        return entry[0]
+
+    # True (and remembered) if this payload has not been logged within log_window
+    def should_log(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(data)
+        if entry is None:
+            return False
+        if entry[2] is not None and now - entry[2] < self.log_window:
+            return False
+        entry[2] = now
+        return True
+
+    # Forget that a payload was logged (its check-in failed), so the next sighting logs it again
+    def forget_logged(self, data):
+        entry = self._entries.get(data)
+        if entry is not None:
+            entry[2] = None
+
+    # Drop expired entries, at most once per minute
+    def _sweep(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 60
+        expired = [data for data, (_, seen, logged, _) in self._entries.items()
+                   if now - seen > self.ttl and (logged is None or now - logged >= self.log_window)]
+        for data in expired:
+            del self._entries[data]
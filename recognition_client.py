@@ -0,0 +1,89 @@
+import base64
+import json
+import os
+import urllib.error
+import urllib.request
+import cv2
+
+# Base URL of a running recognition_service (e.g. http://127.0.0.1:8765); kiosks work locally when unset
+SERVICE_URL = os.environ.get("ATTENDANCE_SERVICE_URL")
+
+
+# Raised when the service can't be reached or rejects a request
+class ServiceError(Exception):
+    pass
+
+
+# Thin HTTP client for recognition_service. Every call blocks, so kiosks make them from a background worker.
+class RecognitionClient:
+    def __init__(self, base_url, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(self.base_url + path, data=data,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise ServiceError(f"Recognition service: {message}") from e
+        except (urllib.error.URLError, OSError) as e:
+            raise ServiceError(f"Recognition service unavailable: {e}") from e
+
+    @staticmethod
+    def _encode_frame(frame_bgr):
+        ok, jpeg = cv2.imencode('.jpg', frame_bgr, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not ok:
+            raise ServiceError("Frame could not be encoded")
+        return base64.b64encode(jpeg.tobytes()).decode('ascii')
+
+    def health(self):
+        return self._request('/health')
+
+    # (name, distance) of the closest registered face, or (None, None) when nobody is within tolerance
+    def closest(self, encoding, crn):
+        result = self._request('/recognize', {'crn': crn, 'encoding': [float(x) for x in encoding]})
+        return result['name'], result['distance']
+
+    # Same result as util.is_gallery_stale, from the galleries the service matches against
+    def is_gallery_stale(self, crn):
+        return self._request('/gallery/status', {'crn': crn})['stale']
+
+    # Same results as util.recognize_from_encoding
+    def recognize_from_encoding(self, encoding, crn):
+        name, _ = self.closest(encoding, crn)
+        return name or 'unknown_person'
+
+    # Same results as util.recognize: a name, 'unknown_person' or 'no_persons_found'
+    def recognize(self, frame_bgr, crn, detection_scale):
+        return self._request('/recognize', {'crn': crn, 'image': self._encode_frame(frame_bgr),
+                                            'detection_scale': detection_scale})['name']
+
+    # Same results as util.recognize_all: the names of the registered students in the frame
+    def recognize_all(self, frame_bgr, crn, detection_scale):
+        return self._request('/recognize', {'crn': crn, 'image': self._encode_frame(frame_bgr),
+                                            'detection_scale': detection_scale, 'all': True})['names']
+
+    # Check a scanned QR payload in; returns (student details or None, whether attendance was logged)
+    def qr_checkin(self, crn, data):
+        result = self._request('/qr/checkin', {'crn': crn, 'data': base64.b64encode(data).decode('ascii')})
+        return result['student'], result['logged']
+
+    # Log attendance records (attendance_log.AttendanceRecord) through the service
+    def log_records(self, crn, records):
+        events = [{'timestamp': record.timestamp, 'username': record.username, 'action': record.action,
+                   'email': record.email} for record in records]
+        return self._request('/events', {'crn': crn, 'events': events})['logged']
+
+
+# Client for the configured service, or None when kiosks should do the work themselves
+def get_client():
+    if not SERVICE_URL:
+        return None
+    return RecognitionClient(SERVICE_URL)
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import base64
+import json
+import math
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import util
+import attendance_log
+import qr_payload
+import storage
+from qr_scanner import QRScanCache
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Largest request body accepted (a JPEG frame is well under this)
+MAX_BODY_BYTES = 8 * 1024 * 1024
+
+
+# Error answered with an HTTP status and a JSON {"error": message} body
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+# Bytes of a base64 request field
+def _decode_base64(data):
+    try:
+        return base64.b64decode(data, validate=True)
+    except (TypeError, ValueError):
+        raise HTTPError(400, "Field is not valid base64")
+
+
+# Decode a base64 JPEG/PNG from a request into a BGR frame
+def decode_image(data):
+    frame = cv2.imdecode(np.frombuffer(_decode_base64(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        raise HTTPError(400, "Image could not be decoded")
+    return frame
+
+
+# Headless recognition service shared by the kiosks on one machine.
+# Each course's FaceGallery, QR roster and check-in debounce cache stay warm in this process, and attendance
+# events go through the shared group-commit writers. Requests are served by an asyncio HTTP server; the CPU
+# work (face detection, encoding, matching) runs on a bounded thread pool, and when max_pending jobs are
+# already waiting new requests are turned away with 503 instead of queueing without limit.
+class RecognitionService:
+    def __init__(self, max_workers=2, max_pending=16, detection_scale=util.DETECTION_SCALE, checkin_window=300):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='recognition')
+        self.max_pending = max_pending
+        self.pending = 0
+        self.detection_scale = detection_scale
+        self.checkin_window = checkin_window
+        self._scan_caches = {}
+        self._lock = threading.Lock()
+        self.routes = {
+            ('GET', '/health'): self.health,
+            ('POST', '/recognize'): self.recognize,
+            ('POST', '/gallery/status'): self.gallery_status,
+            ('POST', '/qr/checkin'): self.qr_checkin,
+            ('POST', '/events'): self.log_events,
+        }
+
+    # Run fn(*args) on the worker pool, refusing the job when the pool is saturated
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise HTTPError(503, "Recognition service is busy, try again")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    # Check-in debounce cache of a course, shared by every kiosk that checks in through the service.
+    # Builds the roster on first use, so like everything that touches storage it runs on the worker pool.
+    def scan_cache(self, crn):
+        with self._lock:
+            cache = self._scan_caches.get(crn)
+            if cache is None:
+                roster = storage.get_storage().roster(crn)
+                cache = self._scan_caches[crn] = QRScanCache(lambda data: qr_payload.parse_payload(data, roster),
+                                                             log_window=self.checkin_window)
+            return cache
+
+    async def health(self, request):
+        return {'status': 'ok', 'pending': self.pending}
+
+    # {"crn", "encoding": [128 floats]} -> {"name", "distance"}
+    # {"crn", "image": base64, "detection_scale"?, "all"?} -> {"name"}, or {"names"} when "all" is true
+    async def recognize(self, request):
+        crn = _require_crn(request)
+        if 'encoding' in request:
+            try:
+                encoding = np.asarray(request['encoding'], dtype=np.float32)
+            except (TypeError, ValueError):
+                encoding = None
+            if encoding is None or encoding.shape != (128,):
+                raise HTTPError(400, "encoding must be a list of 128 numbers")
+            name, distance = await self.run(self._closest, crn, encoding)
+            return {'name': name, 'distance': None if distance is None else float(distance)}
+
+        image = _require(request, 'image')
+        detection_scale = request.get('detection_scale', self.detection_scale)
+        if isinstance(detection_scale, bool) or not isinstance(detection_scale, (int, float)) \
+                or not math.isfinite(detection_scale) or detection_scale <= 0:
+            raise HTTPError(400, "detection_scale must be a positive number")
+        if request.get('all'):
+            return {'names': await self.run(self._recognize_image, crn, image, detection_scale, util.recognize_all)}
+        return {'name': await self.run(self._recognize_image, crn, image, detection_scale, util.recognize)}
+
+    # {"crn"} -> {"stale": bool}, true when the course's faces need re-enrolling
+    async def gallery_status(self, request):
+        crn = _require_crn(request)
+        return {'stale': await self.run(self._gallery_stale, crn)}
+
+    # {"crn", "data": base64 QR payload} -> {"student": {...} or null, "logged": bool}
+    async def qr_checkin(self, request):
+        crn = _require_crn(request)
+        data = _decode_base64(_require(request, 'data'))
+        student, logged = await self.run(self._checkin, crn, data)
+        return {'student': student, 'logged': logged}
+
+    # {"crn", "events": [{"username", "action", "email"?, "timestamp"?}]} -> {"logged": count}
+    async def log_events(self, request):
+        crn = _require_crn(request)
+        events = _require(request, 'events')
+        if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+            raise HTTPError(400, "events must be a list of objects")
+        records = []
+        for event in events:
+            record = attendance_log.make_record(_require_log_field(event, 'username'),
+                                                _require_log_field(event, 'action'),
+                                                email=_require_log_field(event, 'email') if 'email' in event else '')
+            if 'timestamp' in event:
+                # Keep the time the kiosk saw the student, not when the request arrived
+                try:
+                    datetime.strptime(event['timestamp'], attendance_log.TIMESTAMP_FORMAT)
+                except (TypeError, ValueError):
+                    raise HTTPError(400, f"Bad timestamp: {event['timestamp']}")
+                record = record._replace(timestamp=event['timestamp'])
+            records.append(record)
+        # Queuing can block while the writer catches up
+        return {'logged': await self.run(self._log_records, crn, records)}
+
+    # The jobs below run on the worker pool: they read storage, take self._lock or do CPU work, none of which
+    # may hold up the event loop.
+
+    def _closest(self, crn, encoding):
+        _check_course(crn)
+        return util.get_face_gallery(crn).closest(encoding)
+
+    def _gallery_stale(self, crn):
+        _check_course(crn)
+        return util.is_gallery_stale(crn)
+
+    def _recognize_image(self, crn, image, detection_scale, recognize):
+        _check_course(crn)
+        return recognize(decode_image(image), crn, detection_scale)
+
+    def _checkin(self, crn, data):
+        _check_course(crn)
+        cache = self.scan_cache(crn)
+        with self._lock:
+            student = cache.lookup(data)
+            logged = student is not None and cache.should_log(data)
+        if logged:
+            attendance_log.get_writer(crn).log(attendance_log.make_record(
+                student.get('username', 'Unknown'), 'Present', email=student.get('email', 'Unknown')))
+        return student, logged
+
+    def _log_records(self, crn, records):
+        _check_course(crn)
+        attendance_log.get_writer(crn).log_many(records)
+        return len(records)
+
+    # Serve one keep-alive connection
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+
+                status, body = await self.dispatch(method, path.split('?', 1)[0], headers, reader)
+                payload = json.dumps(body).encode('utf-8')
+                # After a rejected oversized body the stream is out of step, so the connection is closed
+                keep_alive = headers.get('connection', '').lower() != 'close' and status != 413
+                writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                             + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers, reader):
+        try:
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY_BYTES:
+                raise HTTPError(413, "Request body too large")
+            body = await reader.readexactly(length) if length else b''
+
+            handler = self.routes.get((method, path))
+            if handler is None:
+                known_path = any(route_path == path for _, route_path in self.routes)
+                raise HTTPError(405 if known_path else 404, f"No route for {method} {path}")
+            try:
+                request = json.loads(body) if body else {}
+            except ValueError:
+                raise HTTPError(400, "Request body must be JSON")
+            if not isinstance(request, dict):
+                raise HTTPError(400, "Request body must be a JSON object")
+            return 200, await handler(request)
+        except HTTPError as e:
+            return e.status, {'error': e.message}
+        except Exception as e:
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Recognition service listening on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+# A required field of a JSON request
+def _require(request, key):
+    if key not in request:
+        raise HTTPError(400, f"Missing field: {key}")
+    return request[key]
+
+
+# A text field of an event that goes into a log line. The log is ", "-separated with one event per line,
+# so a value containing either would corrupt the line or forge another event.
+def _require_log_field(event, key):
+    value = _require(event, key)
+    if not isinstance(value, str) or ', ' in value or '\n' in value or '\r' in value:
+        raise HTTPError(400, f"Invalid {key}: {value!r}")
+    return value
+
+
+# The "crn" field of a request. CRNs name directories under the database root, so anything that could step
+# outside it is refused.
+def _require_crn(request):
+    crn = _require(request, 'crn')
+    if not isinstance(crn, str) or crn in ('', '.', '..') or '/' in crn or '\\' in crn:
+        raise HTTPError(400, f"Invalid CRN: {crn!r}")
+    return crn
+
+
+# Refuse requests for courses that don't exist (reads storage, so only call it from the worker pool)
+def _check_course(crn):
+    if not storage.get_storage().course_exists(crn):
+        raise HTTPError(404, f"Unknown CRN {crn}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve face recognition, QR check-in and event logging to kiosks.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Address to listen on (default: localhost only)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument('--workers', type=int, default=2, help="Threads for face detection and matching")
+    parser.add_argument('--max-pending', type=int, default=16, help="Jobs allowed to wait before answering 503")
+    parser.add_argument('--preload', nargs='*', default=[], help="CRNs whose galleries are loaded at startup")
+    args = parser.parse_args(argv)
+
+    service = RecognitionService(args.workers, args.max_pending)
+    for crn in args.preload:
+        util.get_face_gallery(crn).refresh()
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        attendance_log.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+import json
+import os
+import tempfile
+from openpyxl import Workbook
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+import storage
+
+# Per-student summary, updated incrementally from the log
+EXCEL_REPORT_FILENAME = "attendance_report.xlsx"
+PDF_REPORT_FILENAME = "attendance_report.pdf"
+REPORT_STATE_FILENAME = "attendance_report_state.json"
+REPORT_STATE_VERSION = 1
+
+# Full event listing, always rebuilt from the start of the log
+EVENTS_EXCEL_FILENAME = "attendance_events.xlsx"
+EVENTS_PDF_FILENAME = "attendance_events.pdf"
+
+REPORT_COLUMNS = ["Timestamp", "Username", "Email", "Action"]
+SUMMARY_COLUMNS = ["Username", "Email", "Days Present", "Class Days", "Attendance Rate",
+                   "Check-ins", "Check-outs", "First Seen", "Last Seen"]
+
+# Records between progress callbacks
+PROGRESS_EVERY = 1000
+
+
+# Write a file under a unique temporary name next to it and rename it into place, so readers never see a
+# partial file and two exports of the same report can't write into each other's. write(tmp_path) produces the
+# content; the extension is kept for libraries that check it. The temporary file is removed if anything fails.
+def write_atomically(path, write):
+    base, extension = os.path.splitext(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(base) + '.',
+                                    suffix=extension)
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+# Save a workbook atomically
+def save_workbook(workbook, path):
+    write_atomically(path, workbook.save)
+
+
+# Table layout for a paginated PDF: a title and column headers on every page, one row per line,
+# cells clipped to their column, and a page number in the footer. Rows are drawn as they arrive, but
+# reportlab keeps every finished page in memory until save(), so memory still grows with the number of rows.
+# The canvas writes to a unique temporary file next to path, which save() renames into place; discard()
+# removes it if the report is abandoned.
+class PdfTableLayout:
+    def __init__(self, path, title, columns, column_widths, pagesize=letter, margin=50,
+                 font="Helvetica", font_size=9, line_height=13):
+        self.path = path
+        base, extension = os.path.splitext(path)
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(base) + '.',
+                                             suffix=extension)
+        os.close(fd)
+        self.canvas = canvas.Canvas(self.tmp_path, pagesize=pagesize)
+        self.title = title
+        self.columns = columns
+        self.column_widths = column_widths
+        self.width, self.height = pagesize
+        self.margin = margin
+        self.font = font
+        self.font_size = font_size
+        self.line_height = line_height
+        self.page = 0
+        self.y = None
+
+    # Start a new page with the title and column headers
+    def _new_page(self):
+        if self.page:
+            self._draw_footer()
+            self.canvas.showPage()
+        self.page += 1
+        self.y = self.height - self.margin
+
+        self.canvas.setFont(self.font + "-Bold", self.font_size + 3)
+        self.canvas.drawString(self.margin, self.y, self.title)
+        self.y -= 2 * self.line_height
+
+        self.canvas.setFont(self.font + "-Bold", self.font_size)
+        self._draw_cells(self.columns, self.font + "-Bold")
+        self.y -= 4
+        self.canvas.line(self.margin, self.y, self.width - self.margin, self.y)
+        self.y -= self.line_height
+        self.canvas.setFont(self.font, self.font_size)
+
+    def _draw_footer(self):
+        self.canvas.setFont(self.font, self.font_size - 1)
+        self.canvas.drawRightString(self.width - self.margin, self.margin / 2, f"Page {self.page}")
+
+    # Shorten text with an ellipsis until it fits in the given width
+    def _clip(self, text, font, width):
+        if stringWidth(text, font, self.font_size) <= width:
+            return text
+        while text and stringWidth(text + "...", font, self.font_size) > width:
+            text = text[:-1]
+        return text + "..."
+
+    def _draw_cells(self, values, font):
+        x = self.margin
+        for value, column_width in zip(values, self.column_widths):
+            self.canvas.drawString(x, self.y, self._clip(str(value), font, column_width - 6))
+            x += column_width
+        self.y -= self.line_height
+
+    # Draw one row, breaking to a new page when the current one is full
+    def add_row(self, values):
+        if self.y is None or self.y < self.margin + self.line_height:
+            self._new_page()
+        self._draw_cells(values, self.font)
+
+    def save(self):
+        try:
+            if self.y is None:
+                self._new_page()   # an empty report still gets its header page
+            self._draw_footer()
+            self.canvas.save()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+
+    # Remove the temporary file of a report that won't be saved
+    def discard(self):
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+# Write the Excel and PDF reports from an iterable of attendance records in a single pass.
+# The workbook is write-only (rows are streamed to disk rather than kept as cell objects); the PDF pages are
+# held by reportlab until it is saved (see PdfTableLayout). progress(count) is called every PROGRESS_EVERY
+# records. Returns the number of records written.
+def write_reports(records, excel_path, pdf_path, title, progress=None):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Attendance")
+    sheet.append(REPORT_COLUMNS)
+
+    layout = PdfTableLayout(pdf_path, title, REPORT_COLUMNS, column_widths=[120, 150, 180, 62])
+
+    count = 0
+    try:
+        for record in records:
+            row = [record.timestamp, record.username, record.email, record.action]
+            sheet.append(row)
+            layout.add_row(row)
+            count += 1
+            if progress is not None and count % PROGRESS_EVERY == 0:
+                progress(count)
+
+        save_workbook(workbook, excel_path)
+    except BaseException:
+        layout.discard()
+        raise
+    layout.save()
+    if progress is not None:
+        progress(count)
+    return count
+
+
+# Generate db/<crn>/attendance_events.xlsx and .pdf (every event) from the course's log; returns the number of records
+def generate_event_listing(crn, progress=None, db_path=storage.DB_PATH):
+    backend = storage.storage_for(db_path)
+    dir_path = os.path.join(db_path, crn)
+    os.makedirs(dir_path, exist_ok=True)
+    return write_reports(backend.iter_events(crn),
+                         os.path.join(dir_path, EVENTS_EXCEL_FILENAME),
+                         os.path.join(dir_path, EVENTS_PDF_FILENAME),
+                         f"Attendance events for CRN {crn}", progress)
+
+
+# Per-student running totals behind the summary report, plus the log checkpoint they are up to date with.
+# Class days are the dates on which anyone checked in.
+class AttendanceAggregates:
+    def __init__(self):
+        self.checkpoint = None
+        self.students = {}
+        self.class_days = set()
+
+    # Fold one record into the totals
+    def add(self, record):
+        student = self.students.get(record.username)
+        if student is None:
+            student = self.students[record.username] = {'email': '', 'days': set(), 'check_ins': 0, 'check_outs': 0,
+                                                        'first_seen': record.timestamp, 'last_seen': record.timestamp}
+        if record.email:
+            student['email'] = record.email
+        student['first_seen'] = min(student['first_seen'], record.timestamp)
+        student['last_seen'] = max(student['last_seen'], record.timestamp)
+        if record.action == 'Present':
+            day = storage.event_date(record.timestamp)
+            student['check_ins'] += 1
+            student['days'].add(day)
+            self.class_days.add(day)
+        else:
+            student['check_outs'] += 1
+
+    # One summary row per student, by username
+    def rows(self):
+        class_days = len(self.class_days)
+        for username in sorted(self.students):
+            student = self.students[username]
+            days = len(student['days'])
+            rate = f"{100 * days / class_days:.0f}%" if class_days else "-"
+            yield [username, student['email'], days, class_days, rate, student['check_ins'],
+                   student['check_outs'], student['first_seen'], student['last_seen']]
+
+    def to_json(self):
+        students = {username: dict(student, days=sorted(student['days']))
+                    for username, student in self.students.items()}
+        return {'version': REPORT_STATE_VERSION, 'checkpoint': self.checkpoint,
+                'class_days': sorted(self.class_days), 'students': students}
+
+    @classmethod
+    def from_json(cls, state):
+        aggregates = cls()
+        if state.get('version') != REPORT_STATE_VERSION:
+            return aggregates
+        aggregates.checkpoint = state['checkpoint']
+        aggregates.class_days = set(state['class_days'])
+        aggregates.students = {username: dict(student, days=set(student['days']))
+                               for username, student in state['students'].items()}
+        return aggregates
+
+
+# Load the saved aggregates, or empty ones if there are none or they can't be read
+def load_aggregates(path):
+    try:
+        with open(path, 'r') as f:
+            return AttendanceAggregates.from_json(json.load(f))
+    except (FileNotFoundError, ValueError, KeyError):
+        return AttendanceAggregates()
+
+
+# Atomically replace the saved aggregates
+def save_aggregates(aggregates, path):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(aggregates.to_json(), f)
+    write_atomically(path, write)
+
+
+# Write the summary workbook and PDF from the aggregates (one row per student, independent of log length)
+def write_summary(aggregates, excel_path, pdf_path, title):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Summary")
+    sheet.append(SUMMARY_COLUMNS)
+    layout = PdfTableLayout(pdf_path, title, ["Username", "Email", "Days", "Rate", "In", "Out", "Last Seen"],
+                            column_widths=[110, 150, 60, 45, 35, 35, 77])
+    try:
+        for row in aggregates.rows():
+            sheet.append(row)
+            username, email, days, class_days, rate, check_ins, check_outs, _, last_seen = row
+            layout.add_row([username, email, f"{days}/{class_days}", rate, check_ins, check_outs, last_seen[:10]])
+        save_workbook(workbook, excel_path)
+    except BaseException:
+        layout.discard()
+        raise
+    layout.save()
+
+
+# Bring db/<crn>/attendance_report.xlsx and .pdf up to date. Only events appended since the saved checkpoint
+# are read and folded into the saved per-student aggregates; if the log was truncated or rewritten since,
+# the aggregates are rebuilt from the start. progress(count) reports the number of new events read.
+# Returns the number of new events.
+def generate_course_reports(crn, progress=None, db_path=storage.DB_PATH):
+    backend = storage.storage_for(db_path)
+    dir_path = os.path.join(db_path, crn)
+    os.makedirs(dir_path, exist_ok=True)
+    state_path = os.path.join(dir_path, REPORT_STATE_FILENAME)
+
+    aggregates = load_aggregates(state_path)
+    if aggregates.checkpoint is not None and not backend.checkpoint_valid(crn, aggregates.checkpoint):
+        aggregates = AttendanceAggregates()
+
+    count = 0
+    for record, checkpoint in backend.iter_events_since(crn, aggregates.checkpoint):
+        aggregates.add(record)
+        aggregates.checkpoint = checkpoint
+        count += 1
+        if progress is not None and count % PROGRESS_EVERY == 0:
+            progress(count)
+
+    write_summary(aggregates, os.path.join(dir_path, EXCEL_REPORT_FILENAME),
+                  os.path.join(dir_path, PDF_REPORT_FILENAME), f"Attendance summary for CRN {crn}")
+    # Saved last: if writing the reports fails, the next run redoes these events from the old checkpoint
+    save_aggregates(aggregates, state_path)
+    if progress is not None:
+        progress(count)
+    return count
@@ -0,0 +1,587 @@
+import abc
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import numpy as np
+import attendance_log
+import log_index
+import log_archive
+import qr_payload
+from gallery_store import (GalleryStore, DB_PATH, FACIAL_RECOGNITION_PATH, ENCODING_SIZE, ENCODING_DTYPE, COLOR_ORDER,
+                           list_crns)
+
+PROFESSOR_DETAILS_FILENAME = "professor_details.txt"
+DEFAULT_SQLITE_PATH = os.path.join(DB_PATH, "attendance.sqlite3")
+
+# Which backend the application uses: "file" (the db/<crn> directory layout) or "sqlite"
+STORAGE_BACKEND = os.environ.get("ATTENDANCE_STORAGE", "file")
+SQLITE_PATH = os.environ.get("ATTENDANCE_SQLITE_PATH", DEFAULT_SQLITE_PATH)
+
+
+# Date part (YYYY-MM-DD) of an event timestamp
+def event_date(timestamp):
+    return timestamp[:10]
+
+
+# What the application needs from a storage backend. Courses hold the professor's login details,
+# encoding stores back each course's FaceGallery, rosters back QR registration and events are the
+# attendance log. Backends implement every abstract method; the queries below have generic defaults.
+class Storage(abc.ABC):
+    # Every CRN known to the backend
+    @abc.abstractmethod
+    def list_crns(self):
+        ...
+
+    @abc.abstractmethod
+    def course_exists(self, crn):
+        ...
+
+    # Create or overwrite a course with its professor's details
+    @abc.abstractmethod
+    def save_course(self, crn, course_name, email, password_hash):
+        ...
+
+    # {'course_name', 'crn', 'email', 'password_hash'} for a course, or None
+    @abc.abstractmethod
+    def get_course(self, crn):
+        ...
+
+    # Encoding store for a course: load() -> (names, encodings), append_many(names, encodings), signature(),
+    # is_stale()
+    @abc.abstractmethod
+    def encoding_store(self, crn):
+        ...
+
+    # Roster of the students registered for QR check-in (see qr_payload.Roster for the interface)
+    @abc.abstractmethod
+    def roster(self, crn):
+        ...
+
+    # Append attendance records (attendance_log.AttendanceRecord)
+    @abc.abstractmethod
+    def append_events(self, crn, records):
+        ...
+
+    # Every attendance record of a course, oldest first
+    @abc.abstractmethod
+    def iter_events(self, crn):
+        ...
+
+    # Events appended after a checkpoint (None for the start of the log), as (record, checkpoint after it) pairs.
+    # Checkpoints are small JSON-serialisable dicts with a 'last_timestamp' key.
+    @abc.abstractmethod
+    def iter_events_since(self, crn, checkpoint):
+        ...
+
+    # False if the log no longer contains the event a checkpoint points at (it was truncated or rewritten)
+    @abc.abstractmethod
+    def checkpoint_valid(self, crn, checkpoint):
+        ...
+
+    # Cheap JSON-serialisable fingerprint that changes whenever a course's events change, for caches
+    @abc.abstractmethod
+    def events_signature(self, crn):
+        ...
+
+    # Attendance records of one student, optionally limited to [since, until] dates (YYYY-MM-DD)
+    def events_for_student(self, crn, username, since=None, until=None):
+        return [record for record in self.iter_events(crn)
+                if record.username == username and _in_range(record.timestamp, since, until)]
+
+    # Attendance records within [since, until] dates (YYYY-MM-DD, either may be None)
+    def events_between(self, crn, since=None, until=None):
+        return [record for record in self.iter_events(crn) if _in_range(record.timestamp, since, until)]
+
+    # Dates on which the course met (anyone was present) but the student was not, within [since, until]
+    def absences_for_student(self, crn, username, since=None, until=None):
+        sessions = set()
+        attended = set()
+        for record in self.iter_events(crn):
+            if record.action != 'Present' or not _in_range(record.timestamp, since, until):
+                continue
+            sessions.add(event_date(record.timestamp))
+            if record.username == username:
+                attended.add(event_date(record.timestamp))
+        return sorted(sessions - attended)
+
+
+# True if the timestamp's date is within the optional [since, until] bounds
+def _in_range(timestamp, since, until):
+    date = event_date(timestamp)
+    return (since is None or date >= since) and (until is None or date <= until)
+
+
+# The original layout: db/<crn>/professor_details.txt, event_log.txt, facial_recognition/ and roster.csv
+class FileStorage(Storage):
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+
+    def crn_path(self, crn):
+        return os.path.join(self.db_path, crn)
+
+    def list_crns(self):
+        return list_crns(self.db_path)
+
+    def course_exists(self, crn):
+        return os.path.exists(self.crn_path(crn))
+
+    def save_course(self, crn, course_name, email, password_hash):
+        dir_path = self.crn_path(crn)
+        os.makedirs(dir_path, exist_ok=True)
+
+        # For now, we're storing details in a text file. This is NOT secure. It's for demonstration only.
+        with open(os.path.join(dir_path, PROFESSOR_DETAILS_FILENAME), "w") as f:
+            f.write(f"Course Name: {course_name}\n")
+            f.write(f"CRN: {crn}\n")
+            f.write(f"Email: {email}\n")
+            f.write(f"Password: {password_hash}\n")
+
+        with open(attendance_log.event_log_path(crn, self.db_path), "w"):
+            pass
+
+    def get_course(self, crn):
+        prof_details_path = os.path.join(self.crn_path(crn), PROFESSOR_DETAILS_FILENAME)
+        if not os.path.exists(prof_details_path):
+            return None
+        with open(prof_details_path, "r") as file:
+            lines = file.readlines()
+        return {
+            'course_name': lines[0].split(":", 1)[1].strip(),
+            'crn': lines[1].split(":", 1)[1].strip(),
+            'email': lines[2].split(":", 1)[1].strip(),
+            'password_hash': lines[3].split(":", 1)[1].strip(),
+        }
+
+    def encoding_store(self, crn):
+        return GalleryStore(os.path.join(self.crn_path(crn), FACIAL_RECOGNITION_PATH))
+
+    def roster(self, crn):
+        return qr_payload.Roster(self.crn_path(crn))
+
+    def append_events(self, crn, records):
+        attendance_log.append_records(attendance_log.event_log_path(crn, self.db_path), records)
+
+    # Archived segments come first (they hold the oldest events), then the live log
+    def iter_events(self, crn):
+        for segment in log_archive.load_segments(crn, self.db_path):
+            yield from segment.records()
+        log_path = attendance_log.event_log_path(crn, self.db_path)
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, "r") as log:
+            for line in log:
+                record = attendance_log.parse_line(line)
+                if record is not None:
+                    yield record
+
+    # Checkpoints are the byte offset just past the last complete line read, plus that line itself so a
+    # rewritten log is detected even when it has since grown past the offset. Reading from the start also
+    # reads the archived segments, which leave the checkpoint at the start of the live log.
+    def iter_events_since(self, crn, checkpoint):
+        if not checkpoint:
+            for segment in log_archive.load_segments(crn, self.db_path):
+                for record in segment.records():
+                    yield record, {'offset': 0, 'last_timestamp': record.timestamp, 'last_line': ''}
+        log_path = attendance_log.event_log_path(crn, self.db_path)
+        if not os.path.exists(log_path):
+            return
+        offset = checkpoint['offset'] if checkpoint else 0
+        last_timestamp = checkpoint['last_timestamp'] if checkpoint else None
+        with open(log_path, "rb") as log:
+            log.seek(offset)
+            for line in log:
+                if not line.endswith(b"\n"):
+                    break   # a line still being appended; picked up next time
+                offset += len(line)
+                text = line.decode('utf-8', errors='surrogateescape')
+                record = attendance_log.parse_line(text)
+                if record is None:
+                    continue
+                last_timestamp = record.timestamp
+                yield record, {'offset': offset, 'last_timestamp': last_timestamp, 'last_line': text}
+
+    # Date and student queries are vectorized filters over the archived columns plus lookups in the live
+    # log's sparse index, instead of reading the whole file
+    def events_for_student(self, crn, username, since=None, until=None):
+        records = []
+        for segment in log_archive.load_segments(crn, self.db_path):
+            records.extend(segment.records(segment.mask_student(username) & segment.mask_between(since, until)))
+        index = log_index.get_log_index(attendance_log.event_log_path(crn, self.db_path))
+        return records + index.events_for_student(username, since, until)
+
+    def events_between(self, crn, since=None, until=None):
+        records = []
+        for segment in log_archive.load_segments(crn, self.db_path):
+            records.extend(segment.records(segment.mask_between(since, until)))
+        index = log_index.get_log_index(attendance_log.event_log_path(crn, self.db_path))
+        return records + index.events_between(since, until)
+
+    # Size and mtime of the live log and of each archive segment
+    def events_signature(self, crn):
+        signature = []
+        for path in log_archive.list_segments(crn, self.db_path) + [attendance_log.event_log_path(crn, self.db_path)]:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        return signature
+
+    def checkpoint_valid(self, crn, checkpoint):
+        if not checkpoint or 'offset' not in checkpoint:
+            return False
+        last_line = checkpoint['last_line'].encode('utf-8', errors='surrogateescape')
+        start = checkpoint['offset'] - len(last_line)
+        try:
+            with open(attendance_log.event_log_path(crn, self.db_path), "rb") as log:
+                log.seek(max(start, 0))
+                return start >= 0 and log.read(len(last_line)) == last_line
+        except FileNotFoundError:
+            return False
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    crn TEXT PRIMARY KEY,
+    course_name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS students (
+    crn TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    email TEXT NOT NULL,
+    PRIMARY KEY (crn, student_id),
+    UNIQUE (crn, email)
+);
+CREATE TABLE IF NOT EXISTS encodings (
+    id INTEGER PRIMARY KEY,
+    crn TEXT NOT NULL,
+    username TEXT NOT NULL,
+    encoding BLOB NOT NULL,
+    UNIQUE (crn, username)
+);
+CREATE TABLE IF NOT EXISTS galleries (
+    crn TEXT PRIMARY KEY,
+    color_order TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    crn TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    username TEXT NOT NULL,
+    email TEXT NOT NULL DEFAULT '',
+    action TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (crn, timestamp);
+CREATE INDEX IF NOT EXISTS events_by_student ON events (crn, username, timestamp);
+"""
+
+
+# Single SQLite database (WAL mode, so kiosks can read while another writes) holding every course
+class SQLiteStorage(Storage):
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection().executescript(_SCHEMA)
+
+    # One connection per thread; sqlite3 connections must not be shared across threads, nor with a forked
+    # child process (such as a report export worker), which gets its own
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def list_crns(self):
+        rows = self.connection().execute(
+            "SELECT crn FROM courses UNION SELECT DISTINCT crn FROM encodings ORDER BY crn").fetchall()
+        return [row[0] for row in rows]
+
+    def course_exists(self, crn):
+        return self.connection().execute("SELECT 1 FROM courses WHERE crn = ?", (crn,)).fetchone() is not None
+
+    def save_course(self, crn, course_name, email, password_hash):
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO courses (crn, course_name, email, password_hash) "
+                               "VALUES (?, ?, ?, ?)", (crn, course_name, email, password_hash))
+
+    def get_course(self, crn):
+        row = self.connection().execute(
+            "SELECT course_name, crn, email, password_hash FROM courses WHERE crn = ?", (crn,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('course_name', 'crn', 'email', 'password_hash'), row))
+
+    def encoding_store(self, crn):
+        return SQLiteEncodingStore(self, crn)
+
+    def roster(self, crn):
+        return SQLiteRoster(self, crn)
+
+    def append_events(self, crn, records):
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT INTO events (crn, timestamp, username, email, action) VALUES (?, ?, ?, ?, ?)",
+                [(crn, r.timestamp, r.username, r.email, r.action) for r in records])
+
+    def iter_events(self, crn):
+        cursor = self.connection().execute(
+            "SELECT timestamp, username, email, action FROM events WHERE crn = ? ORDER BY timestamp, id", (crn,))
+        for row in cursor:
+            yield attendance_log.AttendanceRecord(*row)
+
+    # Checkpoints are the id of the last event read; ids only grow, so newer events always come after it
+    def iter_events_since(self, crn, checkpoint):
+        event_id = checkpoint['event_id'] if checkpoint else 0
+        cursor = self.connection().execute(
+            "SELECT id, timestamp, username, email, action FROM events WHERE crn = ? AND id > ? ORDER BY id",
+            (crn, event_id))
+        for row in cursor:
+            yield attendance_log.AttendanceRecord(*row[1:]), {'event_id': row[0], 'last_timestamp': row[1]}
+
+    def events_signature(self, crn):
+        return list(self.connection().execute("SELECT count(*), max(id) FROM events WHERE crn = ?", (crn,)).fetchone())
+
+    def checkpoint_valid(self, crn, checkpoint):
+        if not checkpoint or 'event_id' not in checkpoint:
+            return False
+        row = self.connection().execute("SELECT timestamp FROM events WHERE crn = ? AND id = ?",
+                                        (crn, checkpoint['event_id'])).fetchone()
+        return row is not None and row[0] == checkpoint['last_timestamp']
+
+    def events_for_student(self, crn, username, since=None, until=None):
+        query = "SELECT timestamp, username, email, action FROM events WHERE crn = ? AND username = ?"
+        query, params = _date_bounds(query, [crn, username], since, until)
+        rows = self.connection().execute(query + " ORDER BY timestamp", params).fetchall()
+        return [attendance_log.AttendanceRecord(*row) for row in rows]
+
+    def events_between(self, crn, since=None, until=None):
+        query, params = _date_bounds("SELECT timestamp, username, email, action FROM events WHERE crn = ?",
+                                     [crn], since, until)
+        rows = self.connection().execute(query + " ORDER BY timestamp, id", params).fetchall()
+        return [attendance_log.AttendanceRecord(*row) for row in rows]
+
+    def absences_for_student(self, crn, username, since=None, until=None):
+        sessions, params = _date_bounds(
+            "SELECT DISTINCT substr(timestamp, 1, 10) FROM events WHERE crn = ? AND action = 'Present'",
+            [crn], since, until)
+        attended, attended_params = _date_bounds(
+            "SELECT DISTINCT substr(timestamp, 1, 10) FROM events "
+            "WHERE crn = ? AND username = ? AND action = 'Present'", [crn, username], since, until)
+        rows = self.connection().execute(f"{sessions} EXCEPT {attended} ORDER BY 1", params + attended_params)
+        return [row[0] for row in rows]
+
+
+# Add optional date bounds on the timestamp column to a query (timestamps sort lexicographically)
+def _date_bounds(query, params, since, until):
+    if since is not None:
+        query += " AND timestamp >= ?"
+        params = params + [since]
+    if until is not None:
+        query += " AND timestamp < ?"
+        params = params + [until + "~"]   # '~' sorts after any time of day
+    return query, params
+
+
+# A course's face encodings stored as float32 BLOBs, with the same interface as GalleryStore
+class SQLiteEncodingStore:
+    def __init__(self, storage, crn):
+        self.storage = storage
+        self.crn = crn
+
+    def signature(self):
+        return self.storage.connection().execute(
+            "SELECT count(*), max(id) FROM encodings WHERE crn = ?", (self.crn,)).fetchone()
+
+    def load(self):
+        rows = self.storage.connection().execute(
+            "SELECT username, encoding FROM encodings WHERE crn = ? ORDER BY id", (self.crn,)).fetchall()
+        names = [row[0] for row in rows]
+        if not rows:
+            return names, np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        encodings = np.frombuffer(b"".join(row[1] for row in rows), dtype=ENCODING_DTYPE)
+        return names, encodings.reshape(len(names), ENCODING_SIZE)
+
+    # Galleries registered before the galleries table existed were encoded by this backend, hence from RGB
+    def color_order(self):
+        row = self.storage.connection().execute(
+            "SELECT color_order FROM galleries WHERE crn = ?", (self.crn,)).fetchone()
+        return COLOR_ORDER if row is None else row[0]
+
+    def is_stale(self):
+        return self.color_order() != COLOR_ORDER
+
+    def append_many(self, names, encodings, color_order=COLOR_ORDER):
+        names = list(names)
+        if not names:
+            return
+        rows = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(len(names), ENCODING_SIZE)
+        try:
+            with self.storage.connection() as connection:
+                # Like GalleryStore, only the first append records the order
+                connection.execute("INSERT OR IGNORE INTO galleries (crn, color_order) VALUES (?, ?)",
+                                   (self.crn, color_order))
+                connection.executemany("INSERT INTO encodings (crn, username, encoding) VALUES (?, ?, ?)",
+                                       [(self.crn, name, row.tobytes()) for name, row in zip(names, rows)])
+        except sqlite3.IntegrityError:
+            raise ValueError("One of the names is already registered.")
+
+
+# QR check-in roster kept in the students table, with the same interface as qr_payload.Roster
+class SQLiteRoster:
+    def __init__(self, storage, crn):
+        self.storage = storage
+        self.crn = crn
+        self.by_id = {}
+        self.by_email = {}
+        self.reload()
+
+    def reload(self):
+        rows = self.storage.connection().execute(
+            "SELECT student_id, username, email FROM students WHERE crn = ?", (self.crn,)).fetchall()
+        entries = [{'student_id': row[0], 'username': row[1], 'email': row[2]} for row in rows]
+        self.by_id = {entry['student_id']: entry for entry in entries}
+        self.by_email = {entry['email']: entry for entry in entries}
+
+    def get(self, student_id):
+        entry = self.by_id.get(student_id)
+        if entry is None:
+            self.reload()
+            entry = self.by_id.get(student_id)
+        return entry
+
+    def get_by_email(self, email):
+        entry = self.by_email.get(email)
+        if entry is None:
+            self.reload()
+            entry = self.by_email.get(email)
+        return entry
+
+    def __contains__(self, email):
+        return email in self.by_email
+
+    def add(self, username, email):
+        return self.add_many([(username, email)])[0]
+
+    def add_many(self, students):
+        connection = self.storage.connection()
+        with connection:
+            # BEGIN IMMEDIATE takes the write lock up front, so two kiosks can't hand out the same ID.
+            # IDs continue from the highest one (fixed-width base36, so max() orders them), not the row count.
+            connection.execute("BEGIN IMMEDIATE")
+            highest = connection.execute("SELECT max(student_id) FROM students WHERE crn = ?", (self.crn,)).fetchone()[0]
+            next_number = qr_payload.parse_student_id(highest) + 1 if highest is not None else 1
+            entries = [{'student_id': qr_payload.format_student_id(next_number + i), 'username': username, 'email': email}
+                       for i, (username, email) in enumerate(students)]
+            try:
+                connection.executemany("INSERT INTO students (crn, student_id, username, email) VALUES (?, ?, ?, ?)",
+                                       [(self.crn, e['student_id'], e['username'], e['email']) for e in entries])
+            except sqlite3.IntegrityError:
+                raise ValueError("One of the emails is already registered.")
+        for entry in entries:
+            self.by_id[entry['student_id']] = entry
+            self.by_email[entry['email']] = entry
+        return entries
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+# The storage backend selected by ATTENDANCE_STORAGE, created on first use
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            if STORAGE_BACKEND == "sqlite":
+                _storage = SQLiteStorage(SQLITE_PATH)
+            else:
+                _storage = FileStorage(DB_PATH)
+        return _storage
+
+
+# The configured backend for the default database root, or the file layout under another root
+def storage_for(db_path=DB_PATH):
+    if os.path.normpath(db_path) == os.path.normpath(DB_PATH):
+        return get_storage()
+    return FileStorage(db_path)
+
+
+# Copy every course of a db/ tree (details, encodings, QR roster, attendance log) into a SQLite database
+def import_db_tree(db_path, sqlite_path):
+    source = FileStorage(db_path)
+    target = SQLiteStorage(sqlite_path)
+    for crn in source.list_crns():
+        course = source.get_course(crn)
+        if course is not None:
+            target.save_course(crn, course['course_name'], course['email'], course['password_hash'])
+
+        source_store = source.encoding_store(crn)
+        names, encodings = source_store.load()
+        target_store = target.encoding_store(crn)
+        existing = set(target_store.load()[0])
+        new = [(name, encoding) for name, encoding in zip(names, encodings) if name not in existing]
+        target_store.append_many([name for name, _ in new], [encoding for _, encoding in new],
+                                 source_store.color_order())
+
+        # Keep each student's ID, since it is printed in their QR code. A student already in the database
+        # under the same ID and email is skipped; one whose ID or email is taken by someone else is reported
+        # rather than imported, since that QR code would check in the wrong student.
+        roster = source.roster(crn)
+        with target.connection() as connection:
+            rows = connection.execute("SELECT student_id, username, email FROM students WHERE crn = ?",
+                                      (crn,)).fetchall()
+            existing_ids = {row[0]: row for row in rows}
+            existing_emails = {row[2]: row for row in rows}
+            students = []
+            conflicts = 0
+            for entry in roster.by_id.values():
+                by_id = existing_ids.get(entry['student_id'])
+                by_email = existing_emails.get(entry['email'])
+                if by_id is None and by_email is None:
+                    students.append((crn, entry['student_id'], entry['username'], entry['email']))
+                elif by_id is not by_email:
+                    conflicts += 1
+                    taken = by_id if by_id is not None else by_email
+                    print(f"{crn}: not importing student {entry['student_id']} ({entry['email']}): "
+                          f"conflicts with {taken[0]} ({taken[2]})", file=sys.stderr)
+            connection.executemany("INSERT INTO students (crn, student_id, username, email) VALUES (?, ?, ?, ?)",
+                                   students)
+            connection.execute("DELETE FROM events WHERE crn = ?", (crn,))
+
+        events = 0
+        batch = []
+        for record in source.iter_events(crn):
+            batch.append(record)
+            if len(batch) >= 10000:
+                target.append_events(crn, batch)
+                events += len(batch)
+                batch = []
+        target.append_events(crn, batch)
+        events += len(batch)
+
+        print(f"{crn}: {len(new)} encoding(s), {len(students)} QR student(s), {conflicts} conflict(s), "
+              f"{events} event(s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a db/ directory tree into the SQLite storage backend.")
+    parser.add_argument('--db', default=DB_PATH, help="Database root directory to import")
+    parser.add_argument('--sqlite', default=SQLITE_PATH, help="SQLite database to import into")
+    args = parser.parse_args(argv)
+    import_db_tree(args.db, args.sqlite)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,34 @@
 import tkinter as tk
 from tkinter import messagebox, dialog
-import pickle
 import os
+import cv2
 import face_recognition
+from face_gallery import FaceGallery
+import face_index
+import storage
 
 # Global or constant for database path
 DB_PATH = "./db"
 FACIAL_RECOGNITION_PATH = "facial_recognition"
 
+# Fraction of the frame size that HOG face detection runs at. Boxes found on the downscaled copy are
+# scaled back up so encodings are still computed on the full-resolution frame. 1.0 disables downscaling.
+DETECTION_SCALE = 0.5
+
 #Return the specific path for a given CRN (Course Registration Number)
 def get_crn_specific_path(crn):
     return os.path.join(DB_PATH, crn, FACIAL_RECOGNITION_PATH)
 
+# One in-memory gallery per CRN, shared by every lookup in this process
+_face_galleries = {}
+
+#Return the cached FaceGallery for a given CRN, creating it on first use
+def get_face_gallery(crn):
+    gallery = _face_galleries.get(crn)
+    if gallery is None:
+        gallery = _face_galleries.setdefault(crn, FaceGallery(storage.get_storage().encoding_store(crn)))
+    return gallery
+
 #Creates and returns a tkinter button with specified properties.
 def get_button(window, text, color, command, fg='white', font_size=20, height=2, width=20):
     """
@@ -86,74 +103,126 @@ def msg_box(title, description):
     messagebox.showinfo(title, description)
 
 #Save the face encoding for a specific CRN (Course Registration Number) to disk.
-def save_face_encoding(crn, filename, encoding):
-    crn_path = get_crn_specific_path(crn)
-    if not os.path.exists(crn_path):
-        os.makedirs(crn_path)
-    with open(os.path.join(crn_path, filename), 'wb') as f:
-        pickle.dump(encoding, f)
-
-#Attempt to recognize a face in an image based on known encodings for a given CRN.
-def recognize(face_image, crn):
-    crn_path = get_crn_specific_path(crn)
-
-    face_locations = face_recognition.face_locations(face_image)
-    if len(face_locations) == 0:
-        return 'no_persons_found'
+def save_face_encoding(crn, name, encoding):
+    get_face_gallery(crn).add(name, encoding)
+    face_index.add_to_campus_index(crn, name, encoding, DB_PATH)
+
+#Detect faces on a downscaled copy of an RGB image and return their boxes in full-resolution coordinates.
+def detect_faces(rgb_image, detection_scale=DETECTION_SCALE, grayscale=False, number_of_times_to_upsample=1):
+    """
+    Runs HOG face detection on a reduced copy of the image.
 
-    face_encodings = face_recognition.face_encodings(face_image, face_locations)
+    Parameters:
+        rgb_image: numpy.ndarray
+            Full-resolution image in RGB channel order.
+        detection_scale: float, optional
+            Size of the detection copy relative to the original. Default is DETECTION_SCALE.
+        grayscale: bool, optional
+            Detect on a single-channel copy, which is cheaper again for HOG. Default is False.
+        number_of_times_to_upsample: int, optional
+            Passed through to face_recognition.face_locations. Default is 1.
 
-    for face_encoding in face_encodings:
-        for filename in os.listdir(crn_path):
-            if filename.endswith('.pkl'):
-                with open(os.path.join(crn_path, filename), 'rb') as f:
-                    known_face_encoding = pickle.load(f)
+    Returns:
+        list: (top, right, bottom, left) boxes in the coordinates of rgb_image.
+    """
+    if detection_scale >= 1.0 and not grayscale:
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample)
+
+    small = rgb_image
+    if detection_scale < 1.0:
+        small = cv2.resize(rgb_image, (0, 0), fx=detection_scale, fy=detection_scale, interpolation=cv2.INTER_AREA)
+    if grayscale:
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+    height, width = rgb_image.shape[:2]
+    scale_y = height / small.shape[0]
+    scale_x = width / small.shape[1]
+    locations = []
+    for top, right, bottom, left in face_recognition.face_locations(small, number_of_times_to_upsample):
+        locations.append((max(0, int(top * scale_y)), min(width, int(right * scale_x)),
+                          min(height, int(bottom * scale_y)), max(0, int(left * scale_x))))
+    return locations
+
+#Detect and encode the faces in a BGR frame from OpenCV, largest face first.
+#Returns (locations, encodings); max_faces limits how many of the largest faces are encoded.
+def detect_and_encode(frame_bgr, detection_scale=DETECTION_SCALE, max_faces=None, grayscale=False):
+    rgb_image = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)  # face_recognition expects RGB, OpenCV delivers BGR
+
+    face_locations = detect_faces(rgb_image, detection_scale, grayscale)
+    face_locations.sort(key=lambda box: (box[2] - box[0]) * (box[1] - box[3]), reverse=True)
+    if max_faces is not None:
+        face_locations = face_locations[:max_faces]
+    if len(face_locations) == 0:
+        return [], []
 
-                matches = face_recognition.compare_faces([known_face_encoding], face_encoding)
+    return face_locations, face_recognition.face_encodings(rgb_image, face_locations)
 
-                print(f"Matches for {filename}: {matches}")  # Debug line
+#Attempt to recognize a face in a BGR frame based on known encodings for a given CRN.
+def recognize(face_image, crn, detection_scale=DETECTION_SCALE):
+    face_locations, face_encodings = detect_and_encode(face_image, detection_scale)
+    if len(face_locations) == 0:
+        return 'no_persons_found'
 
-                if True in matches:
-                    print(f"Matched with filename: {filename}")  # Debug line
-                    return filename.replace('.pkl', '')
+    for name, _ in get_face_gallery(crn).match_many(face_encodings):
+        if name is not None:
+            return name
 
     return 'unknown_person'
 
-#Retrieve the closest matching filename for a given face encoding and CRN
-def get_closest_match(face_encoding, crn):
-    crn_path = get_crn_specific_path(crn)
-    closest_match = None
-    closest_distance = 0.6  # You can adjust the threshold
+#Recognize every face in a BGR frame at once. Returns the names of the registered students found.
+#Faces are encoded in one batch and matched against the whole gallery with a single distance matrix.
+def recognize_all(face_image, crn, detection_scale=1.0):
+    face_locations, face_encodings = detect_and_encode(face_image, detection_scale)
+    if len(face_locations) == 0:
+        return []
+
+    matches = get_face_gallery(crn).match_many(face_encodings)
+    return [name for name, _ in matches if name is not None]
 
-    for filename in os.listdir(crn_path):
-        if filename.endswith('.pkl'):
-            with open(os.path.join(crn_path, filename), 'rb') as f:
-                known_face_encoding = pickle.load(f)
+#Return (name, distance) of the closest registered face for a CRN, or (None, None) if none is within tolerance
+def closest(face_encoding, crn):
+    return get_face_gallery(crn).closest(face_encoding)
 
-            distances = face_recognition.face_distance([known_face_encoding], face_encoding)
-            if distances[0] < closest_distance:
-                closest_distance = distances[0]
-                closest_match = filename.replace('.pkl', '')
+#Whether a CRN's faces were registered by an older version and should be re-enrolled
+def is_gallery_stale(crn):
+    return get_face_gallery(crn).is_stale()
 
-    return closest_match
+#Retrieve the closest matching filename for a given face encoding and CRN
+def get_closest_match(face_encoding, crn):
+    name, _ = get_face_gallery(crn).closest(face_encoding)
+    return name
 
 
 #Attempt to recognize a face from its encoding based on known encodings for a given CRN.
 def recognize_from_encoding(face_encoding, crn):
-    crn_path = get_crn_specific_path(crn)
-    closest_match = None
-    closest_distance = 0.6  # You can adjust the threshold
-
-    for filename in os.listdir(crn_path):
-        if filename.endswith('.pkl'):
-            with open(os.path.join(crn_path, filename), 'rb') as f:
-                known_face_encoding = pickle.load(f)
-
-            distances = face_recognition.face_distance([known_face_encoding], face_encoding)
-            if distances[0] < closest_distance:
-                closest_distance = distances[0]
-                closest_match = filename.replace('.pkl', '')
-
-    return closest_match or 'unknown_person'
-
-
+    name, _ = get_face_gallery(crn).closest(face_encoding)
+    return name or 'unknown_person'
+
+
+# Campus-wide index loaded from disk, together with the signature (index mtime and delta files) it was loaded at
+_campus_index = (None, None)
+
+#Return the persisted campus-wide face index, reloading it if it was rebuilt or updated. None if never built.
+def get_campus_index():
+    global _campus_index
+    signature = face_index.campus_index_signature(DB_PATH)
+    if signature is None:
+        return None
+    index, loaded_signature = _campus_index
+    if index is None or loaded_signature != signature:
+        index = face_index.load_campus_index(DB_PATH)
+        _campus_index = (index, signature)
+    return index
+
+
+#Identify a face encoding across every course. Returns (crn, name) or None.
+#n_probe trades latency for recall; None uses the value the index was built with.
+def recognize_campus_wide(face_encoding, n_probe=None):
+    index = get_campus_index()
+    if index is None:
+        return None
+    match = face_index.identify(index, face_encoding, n_probe=n_probe)
+    if match is None:
+        return None
+    crn, name, _ = match
+    return crn, name
@@ -0,0 +1,122 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import cv2
+import util
+import attendance_log
+
+
+# Stream every step-th frame in [start_frame, end_frame) of a video without holding more than one frame.
+# Skipped frames are only grabbed, not decoded, which is most of the cost of reading a video.
+def iter_frames(path, start_frame=0, end_frame=None, step=1):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video {path}")
+    try:
+        if start_frame:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        frame_index = start_frame
+        while end_frame is None or frame_index < end_frame:
+            if (frame_index - start_frame) % step == 0:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame_index, frame
+            elif not cap.grab():
+                break
+            frame_index += 1
+    finally:
+        cap.release()
+
+
+# Frame rate and frame count of a video
+def probe_video(path):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video {path}")
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+    return fps, frame_count
+
+
+# Recognize students in one time chunk of the video (runs in a worker process).
+# Returns {name: seconds from the start of the video at which they were first seen}.
+def process_chunk(path, crn, start_frame, end_frame, step, fps, detection_scale):
+    first_seen = {}
+    for frame_index, frame in iter_frames(path, start_frame, end_frame, step):
+        for name in util.recognize_all(frame, crn, detection_scale):
+            if name not in first_seen:
+                first_seen[name] = frame_index / fps
+    return first_seen
+
+
+# Split [0, frame_count) into chunks of chunk_seconds, aligned to the sampling step.
+# Containers that don't report a frame count are read as a single chunk.
+def make_chunks(frame_count, fps, chunk_seconds, step):
+    if frame_count <= 0:
+        return [(0, None)]
+    chunk_frames = max(step, int(chunk_seconds * fps) // step * step)
+    return [(start, min(start + chunk_frames, frame_count)) for start in range(0, frame_count, chunk_frames)]
+
+
+# Extract attendance from a recorded lecture; returns {name: first-seen datetime}
+def extract_attendance(path, crn, recording_start, sample_rate=1.0, chunk_seconds=300, workers=None,
+                       detection_scale=1.0):
+    fps, frame_count = probe_video(path)
+    step = max(1, int(round(fps / sample_rate)))
+    chunks = make_chunks(frame_count, fps, chunk_seconds, step)
+
+    first_seen = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_chunk, path, crn, start, end, step, fps, detection_scale)
+                   for start, end in chunks]
+        for future in futures:
+            for name, offset in future.result().items():
+                # The same student shows up in many chunks; keep the earliest sighting
+                if name not in first_seen or offset < first_seen[name]:
+                    first_seen[name] = offset
+
+    return {name: recording_start + timedelta(seconds=offset) for name, offset in first_seen.items()}
+
+
+# Append one Present event per student to db/<crn>/event_log.txt, stamped with when they were first seen
+def append_to_event_log(crn, attendance, action='Present'):
+    records = [attendance_log.make_record(name, action, when=seen)
+               for name, seen in sorted(attendance.items(), key=lambda item: item[1])]
+    writer = attendance_log.get_writer(crn, util.DB_PATH)
+    writer.log_many(records)
+    writer.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record attendance from a lecture video.")
+    parser.add_argument('crn', help="Course registration number")
+    parser.add_argument('video', help="Path of the recorded lecture")
+    parser.add_argument('--sample-rate', type=float, default=1.0, help="Frames analysed per second of video")
+    parser.add_argument('--chunk-seconds', type=float, default=300, help="Length of the chunks processed in parallel")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--detection-scale', type=float, default=1.0, help="Scale of the copy face detection runs on")
+    parser.add_argument('--start', default=None,
+                        help="Wall-clock start of the recording, 'YYYY-MM-DD HH:MM:SS' (default: file mtime minus duration)")
+    args = parser.parse_args(argv)
+
+    if args.start:
+        recording_start = datetime.strptime(args.start, attendance_log.TIMESTAMP_FORMAT)
+    else:
+        fps, frame_count = probe_video(args.video)
+        recording_start = datetime.fromtimestamp(os.path.getmtime(args.video)) - timedelta(seconds=frame_count / fps)
+
+    started = time.perf_counter()
+    attendance = extract_attendance(args.video, args.crn, recording_start, args.sample_rate, args.chunk_seconds,
+                                    args.workers, args.detection_scale)
+    append_to_event_log(args.crn, attendance)
+    print(f"Logged {len(attendance)} student(s) in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()